@@ -15,7 +15,8 @@
 # Date: 08 Oct 2020
 # Version: 1.0.2
 # Usage: prep_splits.py [-h] [-r ROOT_FOLDER] [-s1 S1_ROOT_FOLDER] [-o OUT_FOLDER]
-#                       [-n PATCH_NAMES [PATCH_NAMES ...]] [-name NAME_LMDB]
+#                       [-n PATCH_NAMES [PATCH_NAMES ...]] [-name NAME_LMDB] [--paired] [--upsample]
+#                       [--num_workers NUM_WORKERS] [--commit_interval COMMIT_INTERVAL] [--per_split]
 
 from __future__ import print_function
 import argparse
@@ -23,6 +24,11 @@ import os
 import csv
 from pytorch_utils import prep_lmdb_files
 
+import sys
+sys.path.append('../')
+
+from utils.dataGenBigEarth import SPLIT_NAMES
+
 GDAL_EXISTED = False
 RASTERIO_EXISTED = False
 
@@ -39,6 +45,16 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--splits', dest = 'splits', help = 
                         'csv files each of which contain list of patch names', nargs = '+')
     parser.add_argument('-name', type=str, dest='name', help='name of the creating lmdb file')
+    parser.add_argument('--paired', dest='paired', action='store_true',
+                        help='store the Sentinel-2 bands of the root folder under the same key as the Sentinel-1 polarisations')
+    parser.add_argument('--upsample', dest='upsample', action='store_true',
+                        help='store the Sentinel-2 bands of paired files upsampled to 120x120 as one 12 channel array')
+    parser.add_argument('--num_workers', dest='num_workers', type=int, default=4,
+                        help='number of processes reading the patches')
+    parser.add_argument('--commit_interval', dest='commit_interval', type=int, default=1000,
+                        help='number of patches written in one LMDB transaction')
+    parser.add_argument('--per_split', dest='per_split', action='store_true',
+                        help='write the train, val and test splits (the csv files of -n in this order) to their own LMDB files in the folder of -name')
 
 
     args = parser.parse_args()
@@ -76,10 +92,8 @@ if __name__ == "__main__":
     if args.splits:
         try:
             patch_names_list = []
-            split_names = []
             for csv_file in args.splits:
                 patch_names_list.append([])
-                split_names.append(os.path.basename(csv_file).split('.')[0])
                 with open(csv_file, 'r') as fp:
                     csv_reader = csv.reader(fp, delimiter=',')
                     for row in csv_reader:
@@ -97,5 +111,10 @@ if __name__ == "__main__":
             patch_names_list,
             GDAL_EXISTED,
             RASTERIO_EXISTED,
-            args.name
+            args.name,
+            args.paired,
+            args.upsample,
+            args.num_workers,
+            args.commit_interval,
+            SPLIT_NAMES[:len(patch_names_list)] if args.per_split else None
         )
\ No newline at end of file
@@ -3,6 +3,11 @@ import json
 import os
 import numpy as np
 
+import sys
+sys.path.append('../')
+
+from utils.dataGenBigEarth import interp_band
+
 
 # original labels
 LABELS = [
@@ -208,16 +213,26 @@ def parse_json_labels(f_j_path):
     return j_f_c['labels']
 
 
+#Sentinel-2 bands of the paired LMDB files
+BANDS10 = ['02', '03', '04', '08']
+BANDS20 = ['05', '06', '07', '8A', '11', '12']
+BANDS60 = ['01','09']
+
+
 class dataGenBigEarthTiff:
     def __init__(self, sentinel1Dir=None,
                 bigEarthDir=None,
                 patch_names_list=None,
-                RASTERIO_EXISTED=None, GDAL_EXISTED=None
+                RASTERIO_EXISTED=None, GDAL_EXISTED=None,
+                paired=False, upsample=False
                 ):
 
         self.sentinel1Dir = sentinel1Dir
         self.bigEarthDir = bigEarthDir
         
+        self.paired = paired
+        self.upsample = upsample
+        
         
         self.GDAL_EXISTED = GDAL_EXISTED
         self.RASTERIO_EXISTED = RASTERIO_EXISTED
@@ -256,8 +271,24 @@ class dataGenBigEarthTiff:
 
         sample = {'polarVHs': polarVHs_array, 'polarVVs': polarVVs_array, 
                 'patch_name': imgNmS1, 'multi_hots_o':oldMultiHots}
+        
+        if self.paired:
+            sample.update(self.read_sentinel2_bands(imgNmS2))
                
         return sample
+
+    def read_sentinel2_bands(self, imgNmS2):
+        
+        bands = {}
+        for key, band_names in (('bands10', BANDS10), ('bands20', BANDS20), ('bands60', BANDS60)):
+            bands[key] = np.asarray([read_scale_raster(os.path.join(self.bigEarthDir, imgNmS2, imgNmS2+'_B'+band+'.tif'), self.GDAL_EXISTED, self.RASTERIO_EXISTED)
+                                     for band in band_names]).astype(np.float32)
+        
+        if self.upsample:
+            #final layout of ResNet50_S2 inputs, the loader does not need to interpolate
+            bands = {'bands': np.concatenate((bands['bands10'], interp_band(bands['bands20']), interp_band(bands['bands60'])), axis=0).astype(np.float32)}
+        
+        return bands
     
     
 def s1NameToS2(s1Name):
@@ -267,57 +298,81 @@ def s1NameToS2(s1Name):
     
     
 
-def dumps_pyarrow(obj):
+def pack_multi_hots(multi_hots):
     """
-    Serialize an object.
-    Returns:
-        Implementation-dependent bytes-like object
+    multi hot labels as a packed bitset (numpy.packbits) padded to whole 64 bit words
     """
-    import pyarrow as pa
-    
-    return pa.serialize(obj).to_buffer()
+    packed = np.packbits(np.asarray(multi_hots, dtype=np.uint8))
+    return np.concatenate((packed, np.zeros(-len(packed) % 8, dtype=np.uint8)))
 
 
-def prep_lmdb_files(root_folder, sentinel1Directory, out_folder, patch_names_list, GDAL_EXISTED, RASTERIO_EXISTED,name):
+def split_outputs(out_folder, name, patch_names_list, split_names):
+    """
+    one LMDB file per split in out_folder/name/<split name> and the indices of its patches in dataGenBigEarthTiff
+    """
+    lmdb_paths = []
+    split_indices = []
+    start = 0
+    for split_name, patch_names in zip(split_names, patch_names_list[:3]):
+        lmdb_paths.append(os.path.join(out_folder, name, split_name))
+        split_indices.append(range(start, start + len(patch_names)))
+        start += len(patch_names)
     
-    from torch.utils.data import DataLoader
-    import lmdb
-
-    dataGen = dataGenBigEarthTiff(
-                                sentinel1Dir = sentinel1Directory,
-                                bigEarthDir = root_folder,
-                                patch_names_list=patch_names_list,
-                                GDAL_EXISTED=GDAL_EXISTED,
-                                RASTERIO_EXISTED=RASTERIO_EXISTED
-                                )
+    return lmdb_paths, split_indices
 
-    nSamples = len(dataGen)
-    map_size_ = (dataGen[0]['polarVHs'].nbytes + dataGen[0]['polarVVs'].nbytes )*10*len(dataGen)
-    data_loader = DataLoader(dataGen, num_workers=4, collate_fn=lambda x: x)
 
-    db = lmdb.open(os.path.join(out_folder, name), map_size=map_size_)
+def record_of_sample(sample):
+    """
+    arrays stored in the LMDB file: polarVH, polarVV, [Sentinel-2 bands of paired files], packed multi hot labels
+    """
+    arrays = [sample['polarVHs'], sample['polarVVs']]
+    
+    if 'bands' in sample:
+        arrays.append(sample['bands'])
+    elif 'bands10' in sample:
+        arrays += [sample['bands10'], sample['bands20'], sample['bands60']]
+    
+    arrays.append(pack_multi_hots(sample['multi_hots_o']))
+    return tuple(arrays)
 
-    txn = db.begin(write=True)
-    patch_names = []
-    for idx, data in enumerate(data_loader):
-        polarVH, polarVV, patch_name, multiHots_o = data[0]['polarVHs'], data[0]['polarVVs'], data[0]['patch_name'], data[0]['multi_hots_o']
-        txn.put(u'{}'.format(patch_name).encode('ascii'), dumps_pyarrow((polarVH, polarVV, multiHots_o)))
-        patch_names.append(patch_name)
 
-        if idx % 10000 == 0:
-            print("[%d/%d]" % (idx, nSamples))
-            txn.commit()
-            txn = db.begin(write=True)
+def stats_of_sample(sample):
+    """
+    arrays whose channel statistics are stored in the LMDB file, named as in Normalize
+    """
+    arrays = {'polarVH': sample['polarVHs'], 'polarVV': sample['polarVVs']}
     
-    txn.commit()
-    keys = [u'{}'.format(patch_name).encode('ascii') for patch_name in patch_names]
+    if 'bands' in sample:
+        arrays.update(bands10=sample['bands'][:4], bands20=sample['bands'][4:10], bands60=sample['bands'][10:])
+    elif 'bands10' in sample:
+        arrays.update(bands10=sample['bands10'], bands20=sample['bands20'], bands60=sample['bands60'])
+    
+    return arrays
 
-    with db.begin(write=True) as txn:
-        txn.put(b'__keys__', dumps_pyarrow(keys))
-        txn.put(b'__len__', dumps_pyarrow(len(keys)))
 
-    print("Flushing database ...")
-    db.sync()
-    db.close()
+def prep_lmdb_files(root_folder, sentinel1Directory, out_folder, patch_names_list, GDAL_EXISTED, RASTERIO_EXISTED,name,paired=False,upsample=False,
+                    num_workers=4, commit_interval=1000, split_names=None):
+    
+    from utils.lmdbBuilder import buildLMDB, buildSplitLMDBs
 
+    dataGen = dataGenBigEarthTiff(
+                                sentinel1Dir = sentinel1Directory,
+                                bigEarthDir = root_folder,
+                                patch_names_list=patch_names_list,
+                                GDAL_EXISTED=GDAL_EXISTED,
+                                RASTERIO_EXISTED=RASTERIO_EXISTED,
+                                paired=paired,
+                                upsample=upsample
+                                )
 
+    #number of classes of the packed labels
+    meta = {'numClasses': len(LABELS_SERBIA)}
+
+    if split_names is not None:
+        #single pass over the rasters, every split is written to its own LMDB file
+        lmdb_paths, split_indices = split_outputs(out_folder, name, patch_names_list, split_names)
+        buildSplitLMDBs(lmdb_paths, split_indices, dataGen, dataGen.total_patch, record_of_sample, num_workers, commit_interval, stats_of_sample, meta)
+    else:
+        #the statistics of the single LMDB file are those of the train split, the first csv file
+        buildLMDB(os.path.join(out_folder, name), dataGen, dataGen.total_patch, record_of_sample, num_workers, commit_interval, stats_of_sample, meta,
+                  range(len(patch_names_list[0])))
@@ -3,6 +3,11 @@ import json
 import os
 import numpy as np
 
+import sys
+sys.path.append('../')
+
+from utils.dataGenBigEarth import interp_band
+
 
 
 # original labels
@@ -200,7 +205,7 @@ class dataGenBigEarthTiff:
                 bands10=None, bands20=None, bands60=None,
                 patch_names_list=None,
                 RASTERIO_EXISTED=None, GDAL_EXISTED=None,
-                isSerbia = True
+                isSerbia = True, upsample = False
                 ):
 
         self.bigEarthDir = bigEarthDir
@@ -215,6 +220,7 @@ class dataGenBigEarthTiff:
         self.total_patch = patch_names_list[0] + patch_names_list[1] + patch_names_list[2]
         
         self.isSerbia = isSerbia
+        self.upsample = upsample
 
     def __len__(self):
 
@@ -256,26 +262,64 @@ class dataGenBigEarthTiff:
             oldMultiHots = cls2multiHot_old(labels,LABELS)
         oldMultiHots.astype(int)
 
+        if self.upsample:
+            #final layout of ResNet50_S2 inputs, the loader does not need to interpolate
+            bands = np.concatenate((bands10_array, interp_band(bands20_array), interp_band(bands60_array)), axis=0)
+            sample = {'bands': bands.astype(np.float32), 'patch_name': imgNm, 'multi_hots_o':oldMultiHots}
+            return sample
+
         sample = {'bands10': bands10_array, 'bands20': bands20_array, 'bands60': bands60_array, 
                 'patch_name': imgNm, 'multi_hots_o':oldMultiHots}
                 
         return sample
 
-def dumps_pyarrow(obj):
+def pack_multi_hots(multi_hots):
+    """
+    multi hot labels as a packed bitset (numpy.packbits) padded to whole 64 bit words
+    """
+    packed = np.packbits(np.asarray(multi_hots, dtype=np.uint8))
+    return np.concatenate((packed, np.zeros(-len(packed) % 8, dtype=np.uint8)))
+
+
+def split_outputs(out_folder, name, patch_names_list, split_names):
     """
-    Serialize an object.
-    Returns:
-        Implementation-dependent bytes-like object
+    one LMDB file per split in out_folder/name/<split name> and the indices of its patches in dataGenBigEarthTiff
     """
-    import pyarrow as pa
+    lmdb_paths = []
+    split_indices = []
+    start = 0
+    for split_name, patch_names in zip(split_names, patch_names_list[:3]):
+        lmdb_paths.append(os.path.join(out_folder, name, split_name))
+        split_indices.append(range(start, start + len(patch_names)))
+        start += len(patch_names)
     
-    return pa.serialize(obj).to_buffer()
+    return lmdb_paths, split_indices
 
 
-def prep_lmdb_files(root_folder, out_folder, patch_names_list, GDAL_EXISTED, RASTERIO_EXISTED,lmdbName,isSerbia):
+def record_of_sample(sample):
+    """
+    arrays stored in the LMDB file: bands10, bands20, bands60 or the upsampled 12 channel bands, packed multi hot labels
+    """
+    if 'bands' in sample:
+        return (sample['bands'], pack_multi_hots(sample['multi_hots_o']))
     
-    from torch.utils.data import DataLoader
-    import lmdb
+    return (sample['bands10'], sample['bands20'], sample['bands60'], pack_multi_hots(sample['multi_hots_o']))
+
+
+def stats_of_sample(sample):
+    """
+    arrays whose channel statistics are stored in the LMDB file, named as in Normalize
+    """
+    if 'bands' in sample:
+        return {'bands10': sample['bands'][:4], 'bands20': sample['bands'][4:10], 'bands60': sample['bands'][10:]}
+    
+    return {'bands10': sample['bands10'], 'bands20': sample['bands20'], 'bands60': sample['bands60']}
+
+
+def prep_lmdb_files(root_folder, out_folder, patch_names_list, GDAL_EXISTED, RASTERIO_EXISTED,lmdbName,isSerbia,upsample=False,
+                    num_workers=4, commit_interval=1000, split_names=None):
+    
+    from utils.lmdbBuilder import buildLMDB, buildSplitLMDBs
 
     dataGen = dataGenBigEarthTiff(
                                 bigEarthDir = root_folder,
@@ -285,36 +329,18 @@ def prep_lmdb_files(root_folder, out_folder, patch_names_list, GDAL_EXISTED, RAS
                                 patch_names_list=patch_names_list,
                                 GDAL_EXISTED=GDAL_EXISTED,
                                 RASTERIO_EXISTED=RASTERIO_EXISTED,
-                                isSerbia = isSerbia
+                                isSerbia = isSerbia,
+                                upsample = upsample
                                 )
 
-    nSamples = len(dataGen)
-    map_size_ = (dataGen[0]['bands10'].nbytes + dataGen[0]['bands20'].nbytes + dataGen[0]['bands60'].nbytes)*10*len(dataGen)
-    data_loader = DataLoader(dataGen, num_workers=4, collate_fn=lambda x: x)
-
-    db = lmdb.open(os.path.join(out_folder, lmdbName ), map_size=map_size_)
-
-    txn = db.begin(write=True)
-    patch_names = []
-    for idx, data in enumerate(data_loader):
-        bands10, bands20, bands60, patch_name, multiHots_o = data[0]['bands10'], data[0]['bands20'], data[0]['bands60'], data[0]['patch_name'], data[0]['multi_hots_o']
-        txn.put(u'{}'.format(patch_name).encode('ascii'), dumps_pyarrow((bands10, bands20, bands60, multiHots_o)))
-        patch_names.append(patch_name)
-
-        if idx % 10000 == 0:
-            print("[%d/%d]" % (idx, nSamples))
-            txn.commit()
-            txn = db.begin(write=True)
-    
-    txn.commit()
-    keys = [u'{}'.format(patch_name).encode('ascii') for patch_name in patch_names]
-
-    with db.begin(write=True) as txn:
-        txn.put(b'__keys__', dumps_pyarrow(keys))
-        txn.put(b'__len__', dumps_pyarrow(len(keys)))
-
-    print("Flushing database ...")
-    db.sync()
-    db.close()
-
-
+    #number of classes of the packed labels
+    meta = {'numClasses': len(LABELS_SERBIA if isSerbia else LABELS)}
+
+    if split_names is not None:
+        #single pass over the rasters, every split is written to its own LMDB file
+        lmdb_paths, split_indices = split_outputs(out_folder, lmdbName, patch_names_list, split_names)
+        buildSplitLMDBs(lmdb_paths, split_indices, dataGen, dataGen.total_patch, record_of_sample, num_workers, commit_interval, stats_of_sample, meta)
+    else:
+        #the statistics of the single LMDB file are those of the train split, the first csv file
+        buildLMDB(os.path.join(out_folder, lmdbName), dataGen, dataGen.total_patch, record_of_sample, num_workers, commit_interval, stats_of_sample, meta,
+                  range(len(patch_names_list[0])))
@@ -0,0 +1,241 @@
+#
+# Encodes a whole LMDB split into a code archive with a trained checkpoint.
+# Codes, labels and names are flushed to disk chunk by chunk, an interrupted
+# run continues after the last flushed chunk when it encodes the same split with
+# the same checkpoint (chunks/manifest.json).
+
+import os
+import glob
+import json
+import shutil
+import numpy as np
+from tqdm import tqdm
+import argparse
+import torch
+from torch.utils.data import DataLoader, BatchSampler
+import torch.backends.cudnn as cudnn
+
+import sys
+sys.path.append('../')
+
+from utils.ResNet import ResNet50_S1, ResNet50_S2
+from utils.dataGenBigEarth import dataGenBigEarthLMDB, dataGenBigEarthPairedLMDB, ConcatDataset, DevicePreprocessing, loadChannelStatistics
+from utils.hammingSearch import packCodes, packLabels
+from utils.codeArchive import writePackedCodeArchive, fileHash, ARCHIVE_FILE_NAME
+
+
+parser = argparse.ArgumentParser(description='Encode an LMDB split into a code archive')
+parser.add_argument('--S1LMDBPth', metavar='DATA_DIR',
+                        help='path to the saved sentinel 1 LMDB dataset')
+parser.add_argument('--S2LMDBPth', metavar='DATA_DIR',
+                        help='path to the saved sentinel 2 LMDB dataset')
+parser.add_argument('--pairedLMDBPth', metavar='DATA_DIR', default=None,
+                        help='path to the paired sentinel 1 and sentinel 2 LMDB dataset, replaces S1LMDBPth and S2LMDBPth')
+parser.add_argument('-b', '--batch-size', default=512, type=int,
+                        metavar='N', help='mini-batch size (default: 512)')
+parser.add_argument('--bits', type=int, default=16, help='number of bits to use in hashing')
+parser.add_argument('--checkpoint_pth', '-c', help='path to the pretrained weights file', default=None, type=str)
+parser.add_argument('--num_workers', default=8, type=int, metavar='N',
+                        help='num_workers for data loading in pytorch')
+parser.add_argument('--train_csvS1', metavar='CSV_PTH',
+                        help='path to the csv file of train patches')
+parser.add_argument('--val_csvS1', metavar='CSV_PTH',
+                        help='path to the csv file of val patches')
+parser.add_argument('--test_csvS1', metavar='CSV_PTH',
+                        help='path to the csv file of test patches')
+parser.add_argument('--split', type=str, default='train', choices=['train', 'val', 'test'],
+                        help='split of the LMDB datasets to encode')
+parser.add_argument('--out_folder', metavar='DATA_DIR', help='folder of the resulting code archive')
+parser.add_argument('--chunk_size', default=10000, type=int, metavar='N',
+                        help='number of encoded patches flushed to disk at once')
+parser.add_argument('--serbia', dest='serbia', action='store_true',
+                    help='use the serbia patches')
+parser.add_argument('--batch_upsampling', dest='batch_upsampling', action='store_true',
+                    help='upsample the 20m and 60m bands of whole batches with torch instead of every patch with skimage')
+
+arguments = parser.parse_args()
+
+
+
+def flushChunk(chunk_dir, chunk_idx, S1Codes, S2Codes, labels, S1Names, S2Names):
+    chunkFile = os.path.join(chunk_dir, 'chunk_{:05d}.npz'.format(chunk_idx))
+    with open(chunkFile + '.tmp', 'wb') as f:
+        np.savez(f,
+                 S1Codes=np.concatenate(S1Codes), S2Codes=np.concatenate(S2Codes), labels=np.concatenate(labels),
+                 S1Names=np.array(S1Names), S2Names=np.array(S2Names))
+    os.replace(chunkFile + '.tmp', chunkFile)
+
+
+def flushedChunks(chunk_dir):
+    return sorted(glob.glob(os.path.join(chunk_dir, 'chunk_*.npz')))
+
+
+def encodingManifest():
+    """
+    everything the flushed codes depend on, chunks are only continued by a run with the same manifest
+    """
+    csv_file = {'train': arguments.train_csvS1, 'val': arguments.val_csvS1, 'test': arguments.test_csvS1}[arguments.split]
+    return {
+        'checkpointHash': fileHash(arguments.checkpoint_pth),
+        'split': arguments.split,
+        'csv': os.path.abspath(csv_file),
+        'csvHash': fileHash(csv_file),
+        'bits': arguments.bits,
+        'lmdbPaths': [os.path.abspath(path) if path is not None else None
+                      for path in (arguments.S1LMDBPth, arguments.S2LMDBPth, arguments.pairedLMDBPth)],
+    }
+
+
+def prepareChunkDir(chunk_dir, manifest):
+    """
+    chunk folder whose chunks belong to manifest, chunks of an encoding with another manifest are removed
+    """
+    manifestFile = os.path.join(chunk_dir, 'manifest.json')
+    if os.path.isdir(chunk_dir):
+        flushed = None
+        if os.path.isfile(manifestFile):
+            with open(manifestFile, 'r') as f:
+                flushed = json.load(f)
+        if flushed != manifest:
+            print('=> the flushed chunks belong to another checkpoint, split or dataset, encoding from the start')
+            shutil.rmtree(chunk_dir)
+    
+    if not os.path.isdir(chunk_dir):
+        os.makedirs(chunk_dir)
+        with open(manifestFile, 'w') as f:
+            json.dump(manifest, f)
+
+
+def main():
+
+    #statistics computed by prep_splits, literals for LMDB files written without them
+    channels_mean, channels_std = loadChannelStatistics([arguments.S1LMDBPth, arguments.S2LMDBPth, arguments.pairedLMDBPth], arguments.train_csvS1, arguments.serbia)
+
+
+    if arguments.pairedLMDBPth is not None:
+        #both modalities of a patch are read from one value of the paired LMDB file
+        dataset = dataGenBigEarthPairedLMDB(
+                        pairedPthLMDB=arguments.pairedLMDBPth,
+                        state=arguments.split,
+                        upsampling=not arguments.batch_upsampling,
+                        train_csv=arguments.train_csvS1,
+                        val_csv=arguments.val_csvS1,
+                        test_csv=arguments.test_csvS1
+        )
+    else:
+        dataGenS1 = dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=arguments.S1LMDBPth,
+                        isSentinel2 = False,
+                        state=arguments.split,
+                        upsampling=False,
+                        train_csv=arguments.train_csvS1,
+                        val_csv=arguments.val_csvS1,
+                        test_csv=arguments.test_csvS1
+        )
+    
+        dataGenS2 = dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=arguments.S2LMDBPth,
+                        isSentinel2 = True,
+                        state=arguments.split,
+                        upsampling=not arguments.batch_upsampling,
+                        train_csv=arguments.train_csvS1,
+                        val_csv=arguments.val_csvS1,
+                        test_csv=arguments.test_csvS1
+        )
+    
+        dataset = ConcatDataset(dataGenS1, dataGenS2)
+
+
+    chunk_dir = os.path.join(arguments.out_folder, 'chunks')
+    prepareChunkDir(chunk_dir, encodingManifest())
+
+    #resume after the patches of the chunks which have already been flushed
+    chunkFiles = flushedChunks(chunk_dir)
+    startIdx = 0
+    for chunkFile in chunkFiles:
+        with np.load(chunkFile) as chunk:
+            startIdx += len(chunk['S1Names'])
+
+    if startIdx > 0:
+        print('=> resuming after {} flushed chunks ({}/{} patches)'.format(len(chunkFiles), startIdx, len(dataset)))
+
+
+    modelS1 = ResNet50_S1(arguments.bits)
+    modelS2 = ResNet50_S2(arguments.bits)
+
+    if torch.cuda.is_available():
+        torch.backends.cudnn.enabled = True
+        cudnn.benchmark = True
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    modelS1.to(device)
+    modelS2.to(device)
+    
+    #the data loader delivers raw batches, they are normalized and concatenated on the device
+    preprocess = DevicePreprocessing(channels_mean, channels_std, device)
+
+    checkpoint = torch.load(arguments.checkpoint_pth, map_location=device)
+    modelS1.load_state_dict(checkpoint['state_dictS1'])
+    modelS2.load_state_dict(checkpoint['state_dictS2'])
+
+    print("=> loaded checkpoint '{}' (epoch {})".format(arguments.checkpoint_pth, checkpoint['epoch']))
+
+    modelS1.eval()
+    modelS2.eval()
+
+
+    #the datasets read whole minibatches of the remaining patches in one transaction each
+    data_loader = DataLoader(dataset, sampler=BatchSampler(range(startIdx, len(dataset)), arguments.batch_size, drop_last=False),
+                             batch_size=None, num_workers=arguments.num_workers, pin_memory=True)
+
+    chunk_idx = len(chunkFiles)
+    S1Codes, S2Codes, labels, S1Names, S2Names = [], [], [], [], []
+
+    with torch.no_grad():
+        for batch_idx, (dataS1,dataS2) in enumerate(tqdm(data_loader, desc="encoding")):
+
+            polars, bands, batchLabels = preprocess(dataS1, dataS2)
+
+            logitsS1 = modelS1(polars)
+            logitsS2 = modelS2(bands)
+
+            binaryS1 = (torch.sign(logitsS1 - 0.5) + 1 ) / 2
+            binaryS2 = (torch.sign(logitsS2 - 0.5) + 1 ) / 2
+
+            S1Codes.append(packCodes(binaryS1).cpu().numpy())
+            S2Codes.append(packCodes(binaryS2).cpu().numpy())
+            labels.append(packLabels(batchLabels).cpu().numpy())
+            S1Names += list(dataS1['patchName'])
+            S2Names += list(dataS2['patchName'])
+
+            if len(S1Names) >= arguments.chunk_size:
+                flushChunk(chunk_dir, chunk_idx, S1Codes, S2Codes, labels, S1Names, S2Names)
+                chunk_idx += 1
+                S1Codes, S2Codes, labels, S1Names, S2Names = [], [], [], [], []
+
+    if len(S1Names) > 0:
+        flushChunk(chunk_dir, chunk_idx, S1Codes, S2Codes, labels, S1Names, S2Names)
+
+
+    S1Codes, S2Codes, labels, S1Names, S2Names = [], [], [], [], []
+    for chunkFile in flushedChunks(chunk_dir):
+        with np.load(chunkFile) as chunk:
+            S1Codes.append(chunk['S1Codes'])
+            S2Codes.append(chunk['S2Codes'])
+            labels.append(chunk['labels'])
+            S1Names += list(chunk['S1Names'])
+            S2Names += list(chunk['S2Names'])
+
+    archiveFile = os.path.join(arguments.out_folder, ARCHIVE_FILE_NAME)
+    writePackedCodeArchive(archiveFile, np.concatenate(S1Codes), np.concatenate(S2Codes), np.concatenate(labels),
+                           len(dataset[0][0]['label']), S1Names, S2Names, arguments.bits,
+                           epoch=checkpoint['epoch'], checkpointHash=fileHash(arguments.checkpoint_pth))
+
+    shutil.rmtree(chunk_dir)
+    print('=> wrote {} encoded patches to {}'.format(len(S1Names), archiveFile))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#
+# Local retrieval service: keeps both hashing models and the code archive resident and
+# answers cross-modal top-k queries over HTTP. Concurrent queries are batched into single
+# forward passes.
+#
+# POST /query with a JSON body, either
+#     {"patchNames": ["<S1 patch name>", ...]}                  patches are read from the LMDB datasets
+#     {"S1": [<2x120x120 VH,VV>, ...], "S2": [<12x120x120 bands>, ...]}   raw arrays, S2 bands upsampled
+#                                                                 and ordered as bands10, bands20, bands60
+# and an optional "k". The answer holds the neighbours of every query for S1-S1, S1-S2, S2-S1 and S2-S2.
+
+import os
+import json
+import queue
+import threading
+import time
+import argparse
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import sys
+sys.path.append('../')
+
+from utils.ResNet import ResNet50_S1, ResNet50_S2
+from utils.dataGenBigEarth import dataGenBigEarthLMDB, dataGenBigEarthPairedLMDB, ToNormalizedTensor, loadChannelStatistics, splitsOfLMDB
+from utils.hammingSearch import PackedHammingIndex, loadMultiIndexHashing, unpackCodes
+from utils.codeArchive import CodeArchive, ARCHIVE_FILE_NAME
+
+
+parser = argparse.ArgumentParser(description='Cross-modal Sentinel CBIR retrieval service')
+parser.add_argument('--S1LMDBPth', metavar='DATA_DIR', default=None,
+                        help='path to the saved sentinel 1 LMDB dataset, needed for queries by patch name')
+parser.add_argument('--S2LMDBPth', metavar='DATA_DIR', default=None,
+                        help='path to the saved sentinel 2 LMDB dataset, needed for queries by patch name')
+parser.add_argument('--pairedLMDBPth', metavar='DATA_DIR', default=None,
+                        help='path to the paired sentinel 1 and sentinel 2 LMDB dataset, replaces S1LMDBPth and S2LMDBPth')
+parser.add_argument('--bits', type=int, default=16, help='number of bits to use in hashing')
+parser.add_argument('--checkpoint_pth', '-c', help='path to the pretrained weights file', default=None, type=str)
+parser.add_argument('--dataset', metavar='DATA_DIR', help='path to the folder of the code archive')
+parser.add_argument('--index', type=str, default='packed', choices=['packed', 'mih'],
+                    help='search index of the archive codes: packed linear scan or multi-index hashing')
+parser.add_argument('--k', type=int, default=20, help='default number of retrived images per query')
+parser.add_argument('--host', type=str, default='127.0.0.1', help='address the service listens on')
+parser.add_argument('--port', type=int, default=8765, help='port the service listens on')
+parser.add_argument('--max_batch', type=int, default=64, help='maximum number of queries in one forward pass')
+parser.add_argument('--max_delay_ms', type=float, default=5.0,
+                    help='time to wait for more concurrent queries before running a forward pass')
+parser.add_argument('--serbia', dest='serbia', action='store_true',
+                    help='use the serbia patches')
+
+arguments = parser.parse_args()
+
+
+#shapes of the raw arrays of a query: VH and VV, and the bands10, bands20 and bands60 upsampled to 120x120
+S1_SHAPE = (2, 120, 120)
+S2_SHAPE = (12, 120, 120)
+
+
+class PendingQuery(object):
+    def __init__(self, polars, bands, k):
+        self.polars = polars
+        self.bands = bands
+        self.k = k
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+
+class BatchingRetriever(object):
+    """Collects concurrent queries and answers them with one forward pass per modality"""
+    def __init__(self, modelS1, modelS2, indexS1, indexS2, archive, device, max_batch, max_delay):
+        self.modelS1 = modelS1
+        self.modelS2 = modelS2
+        self.indexS1 = indexS1
+        self.indexS2 = indexS2
+        self.archive = archive
+        self.device = device
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queries = queue.Queue()
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, polars, bands, k):
+        query = PendingQuery(polars, bands, k)
+        self.queries.put(query)
+        return query
+
+    def collect(self):
+        batch = [self.queries.get()]
+        deadline = time.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queries.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                self.answer(batch)
+            except Exception as e:
+                for query in batch:
+                    query.error = str(e)
+            for query in batch:
+                query.done.set()
+
+    def encode(self, model, inputs):
+        with torch.no_grad():
+            logits = model(torch.stack(inputs).to(self.device))
+        return (torch.sign(logits - 0.5) + 1 ) / 2
+
+    def encodeQueries(self, model, queries, attribute):
+        """
+        queries which could be encoded and their codes, when the batch fails every query is encoded on its own
+        and only the failing ones get an error
+        """
+        try:
+            return queries, self.encode(model, [getattr(query, attribute) for query in queries])
+        except Exception:
+            pass
+
+        encoded = []
+        codes = []
+        for query in queries:
+            try:
+                codes.append(self.encode(model, [getattr(query, attribute)]))
+                encoded.append(query)
+            except Exception as e:
+                query.error = str(e)
+        if len(codes) == 0:
+            return encoded, None
+        return encoded, torch.cat(codes)
+
+    def neighbours(self, index, names, codes, k):
+        distances, indices = index.search(codes, k)
+        return [[{'name': names[idx], 'distance': int(distance)} for distance, idx in zip(rowDistances.tolist(), rowIndices.tolist())]
+                for rowDistances, rowIndices in zip(distances, indices)]
+
+    def answer(self, batch):
+        k = max(query.k for query in batch)
+        for query in batch:
+            query.result = {}
+
+        for modality, model, attribute in (('S1', self.modelS1, 'polars'), ('S2', self.modelS2, 'bands')):
+            queries = [query for query in batch if getattr(query, attribute) is not None and query.error is None]
+            if len(queries) == 0:
+                continue
+
+            queries, codes = self.encodeQueries(model, queries, attribute)
+            if len(queries) == 0:
+                continue
+            toS1 = self.neighbours(self.indexS1, self.archive.S1Names, codes, k)
+            toS2 = self.neighbours(self.indexS2, self.archive.S2Names, codes, k)
+
+            for query, neighboursS1, neighboursS2 in zip(queries, toS1, toS2):
+                query.result[modality + 'toS1'] = neighboursS1[:query.k]
+                query.result[modality + 'toS2'] = neighboursS2[:query.k]
+
+
+
+class SplitLookup(object):
+    """
+    getByName over the LMDB files of all splits of prep_splits.py --per_split, or over a single LMDB file,
+    dataGenOfState(state) opens the dataset of a split
+    """
+    def __init__(self, lmdbPath, dataGenOfState):
+        states = splitsOfLMDB(lmdbPath) or ['train']
+        self.dataGens = [dataGenOfState(state) for state in states]
+
+    def getByName(self, patchName):
+        for dataGen in self.dataGens:
+            if dataGen.hasName(patchName):
+                return dataGen.getByName(patchName)
+        raise ValueError('unknown patch name {}'.format(patchName))
+
+
+def checkedArray(array, shape, modality, i):
+    array = np.array(array, dtype=np.float32)
+    if array.shape != shape:
+        raise ValueError('{} array {} has the shape {}, expected {}'.format(modality, i, array.shape, shape))
+    return array
+
+
+def makeRequestHandler(retriever, samplesByName, normalizeS1, normalizeS2):
+
+    class RequestHandler(BaseHTTPRequestHandler):
+
+        def sendJSON(self, status, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def inputsOfPatchNames(self, patchNames):
+            if samplesByName is None:
+                raise ValueError('the service has been started without LMDB datasets, query with raw arrays')
+            inputs = []
+            for patchName in patchNames:
+                sampleS1, sampleS2 = samplesByName(patchName)
+                polars = torch.cat((sampleS1['polarVH'], sampleS1['polarVV']), dim=0)
+                bands = torch.cat((sampleS2['bands10'], sampleS2['bands20'], sampleS2['bands60']), dim=0)
+                inputs.append((polars, bands))
+            return inputs
+
+        def inputsOfArrays(self, S1Arrays, S2Arrays):
+            numQueries = max(len(S1Arrays), len(S2Arrays))
+            inputs = []
+            for i in range(numQueries):
+                polars = None
+                bands = None
+                if i < len(S1Arrays):
+                    polars = normalizeS1.stacked(checkedArray(S1Arrays[i], S1_SHAPE, 'S1', i))
+                if i < len(S2Arrays):
+                    bands = normalizeS2.stacked(checkedArray(S2Arrays[i], S2_SHAPE, 'S2', i))
+                inputs.append((polars, bands))
+            return inputs
+
+        def do_POST(self):
+            if self.path != '/query':
+                self.sendJSON(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+
+            try:
+                content = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                k = int(content.get('k', arguments.k))
+                if k < 1:
+                    raise ValueError('k has to be at least 1, got {}'.format(k))
+                if 'patchNames' in content:
+                    inputs = self.inputsOfPatchNames(content['patchNames'])
+                else:
+                    inputs = self.inputsOfArrays(content.get('S1', []), content.get('S2', []))
+            except Exception as e:
+                self.sendJSON(400, {'error': str(e)})
+                return
+
+            pending = [retriever.submit(polars, bands, k) for polars, bands in inputs]
+            for query in pending:
+                query.done.wait()
+
+            errors = [query.error for query in pending if query.error is not None]
+            if len(errors) > 0:
+                self.sendJSON(500, {'error': errors[0]})
+            else:
+                self.sendJSON(200, {'results': [query.result for query in pending]})
+
+    return RequestHandler
+
+
+
+def main():
+
+    #statistics computed by prep_splits, literals for LMDB files written without them
+    channels_mean, channels_std = loadChannelStatistics([arguments.S1LMDBPth, arguments.S2LMDBPth, arguments.pairedLMDBPth], None, arguments.serbia)
+
+
+    normalizeS1 = ToNormalizedTensor(channels_mean, channels_std, False)
+    normalizeS2 = ToNormalizedTensor(channels_mean, channels_std, True)
+
+    samplesByName = None
+    if arguments.pairedLMDBPth is not None:
+        #both modalities of a patch are read from one value of the paired LMDB file
+        dataGenPaired = SplitLookup(arguments.pairedLMDBPth, lambda state: dataGenBigEarthPairedLMDB(
+                        pairedPthLMDB=arguments.pairedLMDBPth, imgTransformS1=normalizeS1, imgTransformS2=normalizeS2,
+                        state=state, upsampling=True))
+        samplesByName = dataGenPaired.getByName
+    elif arguments.S1LMDBPth is not None and arguments.S2LMDBPth is not None:
+        dataGenS1 = SplitLookup(arguments.S1LMDBPth, lambda state: dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=arguments.S1LMDBPth, isSentinel2=False, state=state, imgTransform=normalizeS1, upsampling=False))
+        dataGenS2 = SplitLookup(arguments.S2LMDBPth, lambda state: dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=arguments.S2LMDBPth, isSentinel2=True, state=state, imgTransform=normalizeS2, upsampling=True))
+        samplesByName = lambda patchName: (dataGenS1.getByName(patchName), dataGenS2.getByName(patchName))
+
+
+    modelS1 = ResNet50_S1(arguments.bits)
+    modelS2 = ResNet50_S2(arguments.bits)
+
+    if torch.cuda.is_available():
+        torch.backends.cudnn.enabled = True
+        cudnn.benchmark = True
+        device = torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+
+    modelS1.to(device)
+    modelS2.to(device)
+
+    checkpoint = torch.load(arguments.checkpoint_pth, map_location=device)
+    modelS1.load_state_dict(checkpoint['state_dictS1'])
+    modelS2.load_state_dict(checkpoint['state_dictS2'])
+    modelS1.eval()
+    modelS2.eval()
+
+    print("=> loaded checkpoint '{}' (epoch {})".format(arguments.checkpoint_pth, checkpoint['epoch']))
+
+
+    archive = CodeArchive(os.path.join(arguments.dataset, ARCHIVE_FILE_NAME))
+
+    if arguments.index == 'mih':
+        indexS1 = loadMultiIndexHashing(os.path.join(arguments.dataset, 'mihS1Index.npz'), unpackCodes(archive.S1Codes, archive.bits))
+        indexS2 = loadMultiIndexHashing(os.path.join(arguments.dataset, 'mihS2Index.npz'), unpackCodes(archive.S2Codes, archive.bits))
+    else:
+        indexS1 = PackedHammingIndex.fromPacked(archive.S1Codes.to(device), archive.bits)
+        indexS2 = PackedHammingIndex.fromPacked(archive.S2Codes.to(device), archive.bits)
+
+    print("=> serving {} archived patches".format(len(archive)))
+
+
+    retriever = BatchingRetriever(modelS1, modelS2, indexS1, indexS2, archive, device,
+                                  arguments.max_batch, arguments.max_delay_ms / 1000.0)
+
+    server = ThreadingHTTPServer((arguments.host, arguments.port),
+                                 makeRequestHandler(retriever, samplesByName, normalizeS1, normalizeS2))
+    print('=> listening on http://{}:{}/query'.format(arguments.host, arguments.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,7 @@ import time
 from tqdm import tqdm
 import argparse
 import torch
-import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 import torch.backends.cudnn as cudnn
 
 import sys
@@ -20,6 +19,8 @@ parser.add_argument('--S1LMDBPth', metavar='DATA_DIR',
                         help='path to the saved sentinel 1 LMDB dataset')
 parser.add_argument('--S2LMDBPth', metavar='DATA_DIR',
                         help='path to the saved sentinel 2 LMDB dataset')
+parser.add_argument('--pairedLMDBPth', metavar='DATA_DIR', default=None,
+                        help='path to the paired sentinel 1 and sentinel 2 LMDB dataset, replaces S1LMDBPth and S2LMDBPth')
 parser.add_argument('--S1Dir', metavar='DATA_DIR', help='path which has Sentinel-1 patches')
 parser.add_argument('--S2Dir',metavar='DATA_DIR', help='path which has Sentinel-2 patches')
 
@@ -40,6 +41,10 @@ parser.add_argument('--dataset', metavar='DATA_DIR', help='path to trained data'
 parser.add_argument('--k', type=int, default=20, help='number of retrived images per query')
 parser.add_argument('--serbia', dest='serbia', action='store_true',
                     help='use the serbia patches')
+parser.add_argument('--batch_upsampling', dest='batch_upsampling', action='store_true',
+                    help='upsample the 20m and 60m bands of whole batches with torch instead of every patch with skimage')
+parser.add_argument('--index', type=str, default='packed', choices=['packed', 'mih'],
+                    help='search index of the archive codes: packed linear scan or multi-index hashing')
     
     
 arguments = parser.parse_args()
@@ -52,9 +57,11 @@ if not os.path.isdir(result_dir):
 
 sys.path.append('../')
 
-from utils.dataGenBigEarth import dataGenBigEarthLMDB, ToTensor, Normalize, ConcatDataset
-from utils.metrics import get_mAP, get_k_hamming_neighbours,timer, get_mAP_weighted,\
+from utils.dataGenBigEarth import dataGenBigEarthLMDB, dataGenBigEarthPairedLMDB, ConcatDataset, DevicePreprocessing, loadChannelStatistics
+from utils.metrics import get_mAP_batch, timer, get_mAP_weighted_batch,\
     createTrueColorTiff, falseRepresentationS1, calculateAverageMetric,lineWriteToFile
+from utils.hammingSearch import PackedHammingIndex, loadMultiIndexHashing, packCodes, unpackCodes, packLabels
+from utils.codeArchive import CodeArchive, fileHash, ARCHIVE_FILE_NAME
 
 from utils.ResNet import ResNet50_S1, ResNet50_S2
 
@@ -133,95 +140,63 @@ def main():
     torch.backends.cudnn.enabled = True
     cudnn.benchmark = True
 
-    if arguments.serbia:
-
-            #Sentinel 2 in Serbia Statistics
-            bands_mean = {
-                            'bands10_mean': [ 458.93423 ,  676.8278,  665.719, 2590.4482],
-                            'bands20_mean': [ 1065.233, 2068.3826, 2435.3057, 2647.92, 2010.1838, 1318.5911],
-                            'bands60_mean': [ 341.05457, 2630.7898 ],
-                        }
-        
-            bands_std = {
-                            'bands10_std': [ 315.86624,  305.07462,  302.11145, 310.93375],
-                            'bands20_std': [ 288.43314, 287.29364, 299.83383, 295.51282, 211.81876,  193.92213],
-                            'bands60_std': [ 267.79263, 292.94092 ]    
-                    }
-            
-            #Sentinel 1 in Serbia Statistics
-            polars_mean = {
-                    'polarVH_mean': [ -15.827944 ],
-                    'polarVV_mean': [ -9.317011]
-                }
-
-            polars_std = {
-                    'polarVH_std': [ 0.782826 ],
-                    'polarVV_std': [ 1.8147297]
-            }
-    else:
-
-                bands_mean = {
-                        'bands10_mean': [ 429.9430203 ,  614.21682446,  590.23569706, 2218.94553375],
-                        'bands20_mean': [ 950.68368468, 1792.46290469, 2075.46795189, 2266.46036911, 1594.42694882, 1009.32729131],
-                        'bands60_mean': [ 340.76769064, 2246.0605464 ],
-                    }
-    
-                bands_std = {
-                        'bands10_std': [ 572.41639287,  582.87945694,  675.88746967, 1365.45589904],
-                        'bands20_std': [ 729.89827633, 1096.01480586, 1273.45393088, 1356.13789355, 1079.19066363,  818.86747235],
-                        'bands60_std': [ 554.81258967, 1302.3292881 ]
-                    }
-
+    #statistics computed by prep_splits, literals for LMDB files written without them
+    channels_mean, channels_std = loadChannelStatistics([arguments.S1LMDBPth, arguments.S2LMDBPth, arguments.pairedLMDBPth], arguments.train_csvS1, arguments.serbia)
 
 
     modelS1 = ResNet50_S1(arguments.bits)
     modelS2 = ResNet50_S2(arguments.bits)
     
-    test_dataGenS1 = dataGenBigEarthLMDB(
-                    bigEarthPthLMDB=arguments.S1LMDBPth,
-                    isSentinel2 = False,
-                    state='test',
-                    imgTransform=transforms.Compose([
-                        ToTensor(False),
-                        Normalize(polars_mean, polars_std,False)
-                    ]),
-                    upsampling=False,
-                    train_csv=arguments.train_csvS1,
-                    val_csv=arguments.val_csvS1,
-                    test_csv=arguments.test_csvS1
-    )
-    
+    if arguments.pairedLMDBPth is not None:
+        #both modalities of a patch are read from one value of the paired LMDB file
+        test_dataset = dataGenBigEarthPairedLMDB(
+                        pairedPthLMDB=arguments.pairedLMDBPth,
+                        state='test',
+                        upsampling=not arguments.batch_upsampling,
+                        train_csv=arguments.train_csvS1,
+                        val_csv=arguments.val_csvS1,
+                        test_csv=arguments.test_csvS1
+        )
+    else:
+        test_dataGenS1 = dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=arguments.S1LMDBPth,
+                        isSentinel2 = False,
+                        state='test',
+                        upsampling=False,
+                        train_csv=arguments.train_csvS1,
+                        val_csv=arguments.val_csvS1,
+                        test_csv=arguments.test_csvS1
+        )
     
     
     
-    test_dataGenS2 = dataGenBigEarthLMDB(
-                    bigEarthPthLMDB=arguments.S2LMDBPth,
-                    isSentinel2 = True,
-                    state='test',
-                    imgTransform=transforms.Compose([
-                        ToTensor(True),
-                        Normalize(bands_mean, bands_std,True)
-                    ]),
-                    upsampling=True,
-                    train_csv=arguments.train_csvS1,
-                    val_csv=arguments.val_csvS1,
-                    test_csv=arguments.test_csvS1
-    )
     
+        test_dataGenS2 = dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=arguments.S2LMDBPth,
+                        isSentinel2 = True,
+                        state='test',
+                        upsampling=not arguments.batch_upsampling,
+                        train_csv=arguments.train_csvS1,
+                        val_csv=arguments.val_csvS1,
+                        test_csv=arguments.test_csvS1
+        )
 
-    
-    test_data_loader = DataLoader(ConcatDataset(test_dataGenS1,test_dataGenS2), batch_size=arguments.batch_size, num_workers=arguments.num_workers, shuffle=False, pin_memory=True)
+        test_dataset = ConcatDataset(test_dataGenS1,test_dataGenS2)
+
+    test_data_loader = DataLoader(test_dataset, sampler=BatchSampler(SequentialSampler(test_dataset), arguments.batch_size, drop_last=False), batch_size=None, num_workers=arguments.num_workers, pin_memory=True)
 
     if torch.cuda.is_available():
-        modelS1.cuda()
-        modelS2.cuda()
-        gpuDisabled = False
+        device = torch.device("cuda")
         map_location=lambda storage, loc: storage.cuda()
     else:
-        modelS1.cpu()
-        modelS2.cpu()
-        gpuDisabled = True
+        device = torch.device("cpu")
         map_location='cpu'
+    
+    modelS1.to(device)
+    modelS2.to(device)
+    
+    #the data loader delivers raw batches, they are normalized and concatenated on the device
+    preprocess = DevicePreprocessing(channels_mean, channels_std, device)
 
     checkpointPath = arguments.checkpoint_pth
     checkpoint = torch.load(checkpointPath, map_location=map_location)
@@ -233,21 +208,44 @@ def main():
 
     
     dataset = arguments.dataset
-    trainedLabelsDir = os.path.join(dataset, 'trainedLabels.pt')
-        
-    fileTrainedS1Names = os.path.join(dataset, 'trainedS1Names.npy')
-    fileTrainedS2Names = os.path.join(dataset, 'trainedS2Names.npy')
-    
-    fileGeneratedS1Codes = os.path.join(dataset, 'generatedS1Codes.pt')
-    fileGeneratedS2Codes = os.path.join(dataset, 'generatedS2Codes.pt')
+    archiveFile = os.path.join(dataset, ARCHIVE_FILE_NAME)
     
+    if os.path.isfile(archiveFile):
+        archive = CodeArchive(archiveFile)
+        print("=> opened code archive '{}' (epoch {})".format(archiveFile, archive.epoch))
+        if archive.checkpointHash is not None and archive.checkpointHash != fileHash(checkpointPath):
+            print('WARNING: code archive has been generated with a different checkpoint')
         
-    trainedLabels = torch.load(trainedLabelsDir, map_location=map_location)
-    trainedS1FileNames = np.load(fileTrainedS1Names)
-    trainedS2FileNames = np.load(fileTrainedS2Names)
-    trainedAndGeneratedS1Codes = torch.load(fileGeneratedS1Codes, map_location=map_location)
-    trainedAndGeneratedS2Codes = torch.load(fileGeneratedS2Codes, map_location=map_location)
-
+        trainedLabels = archive.labels.to(device)
+        numClasses = archive.numClasses
+        trainedS1FileNames = archive.S1Names
+        trainedS2FileNames = archive.S2Names
+        packedS1Codes = archive.S1Codes.to(device)
+        packedS2Codes = archive.S2Codes.to(device)
+    else:
+        trainedLabelsDir = os.path.join(dataset, 'trainedLabels.pt')
+            
+        fileTrainedS1Names = os.path.join(dataset, 'trainedS1Names.npy')
+        fileTrainedS2Names = os.path.join(dataset, 'trainedS2Names.npy')
+        
+        fileGeneratedS1Codes = os.path.join(dataset, 'generatedS1Codes.pt')
+        fileGeneratedS2Codes = os.path.join(dataset, 'generatedS2Codes.pt')
+        
+            
+        trainedLabels = torch.load(trainedLabelsDir, map_location=map_location)
+        numClasses = trainedLabels.size(1)
+        trainedLabels = packLabels(trainedLabels)
+        trainedS1FileNames = np.load(fileTrainedS1Names)
+        trainedS2FileNames = np.load(fileTrainedS2Names)
+        packedS1Codes = packCodes(torch.load(fileGeneratedS1Codes, map_location=map_location))
+        packedS2Codes = packCodes(torch.load(fileGeneratedS2Codes, map_location=map_location))
+
+    if arguments.index == 'mih':
+        indexS1 = loadMultiIndexHashing(os.path.join(dataset, 'mihS1Index.npz'), unpackCodes(packedS1Codes, arguments.bits))
+        indexS2 = loadMultiIndexHashing(os.path.join(dataset, 'mihS2Index.npz'), unpackCodes(packedS2Codes, arguments.bits))
+    else:
+        indexS1 = PackedHammingIndex.fromPacked(packedS1Codes, arguments.bits)
+        indexS2 = PackedHammingIndex.fromPacked(packedS2Codes, arguments.bits)
 
 
 
@@ -280,15 +278,8 @@ def main():
         for batch_idx, (dataS1,dataS2) in enumerate(tqdm(test_data_loader, desc="test")):
             totalSize += dataS2["bands10"].size(0)
             
-            if gpuDisabled :
-                bands = torch.cat((dataS2["bands10"], dataS2["bands20"],dataS2["bands60"]), dim=1).to(torch.device("cpu"))
-                polars = torch.cat((dataS1["polarVH"], dataS1["polarVV"]), dim=1).to(torch.device("cpu"))
-                labels = dataS1["label"].to(torch.device("cpu"))  
-
-            else:
-                bands = torch.cat((dataS2["bands10"], dataS2["bands20"],dataS2["bands60"]), dim=1).to(torch.device("cuda"))
-                polars = torch.cat((dataS1["polarVH"], dataS1["polarVV"]), dim=1).to(torch.device("cuda"))
-                labels = dataS1["label"].to(torch.device("cuda"))           
+            polars, bands, labels = preprocess(dataS1, dataS2)
+            packedLabels = packLabels(labels)
 
 
             logitsS1 = modelS1(polars)
@@ -308,35 +299,35 @@ def main():
                 
             
             #S1 to S1
-            neighboursIndices = get_k_hamming_neighbours(trainedAndGeneratedS1Codes, binaryS1)  
-            mapPerBatch = get_mAP(neighboursIndices,arguments.k,trainedLabels,list(labels))
+            _, neighboursIndices = indexS1.search(binaryS1, arguments.k)  
+            mapPerBatch = get_mAP_batch(neighboursIndices,arguments.k,trainedLabels,packedLabels,packed=True)
             mapS1toS1 += mapPerBatch
-            mapPerBatch_Weighted = get_mAP_weighted(neighboursIndices,arguments.k,trainedLabels,list(labels))
+            mapPerBatch_Weighted = get_mAP_weighted_batch(neighboursIndices,arguments.k,trainedLabels,packedLabels,packed=True)
             mapS1toS1_weighted += mapPerBatch_Weighted
             
 
     
             #S1 to S2
-            neighboursIndices = get_k_hamming_neighbours(trainedAndGeneratedS2Codes,binaryS1)  
-            mapPerBatch = get_mAP(neighboursIndices,arguments.k,trainedLabels,list(labels))
+            _, neighboursIndices = indexS2.search(binaryS1, arguments.k)  
+            mapPerBatch = get_mAP_batch(neighboursIndices,arguments.k,trainedLabels,packedLabels,packed=True)
             mapS1toS2 += mapPerBatch
-            mapPerBatch_weighted = get_mAP_weighted(neighboursIndices,arguments.k,trainedLabels,list(labels))
+            mapPerBatch_weighted = get_mAP_weighted_batch(neighboursIndices,arguments.k,trainedLabels,packedLabels,packed=True)
             mapS1toS2_weighted += mapPerBatch_weighted
             
             
             #S2 to S1
-            neighboursIndices = get_k_hamming_neighbours(trainedAndGeneratedS1Codes,binaryS2)  
-            mapPerBatch = get_mAP(neighboursIndices,arguments.k,trainedLabels,list(labels))
+            _, neighboursIndices = indexS1.search(binaryS2, arguments.k)  
+            mapPerBatch = get_mAP_batch(neighboursIndices,arguments.k,trainedLabels,packedLabels,packed=True)
             mapS2toS1 += mapPerBatch    
-            mapPerBatch_weighted = get_mAP_weighted(neighboursIndices,arguments.k,trainedLabels,list(labels))
+            mapPerBatch_weighted = get_mAP_weighted_batch(neighboursIndices,arguments.k,trainedLabels,packedLabels,packed=True)
             mapS2toS1_weighted += mapPerBatch_weighted
                   
                   
             #S2 to S2
-            neighboursIndices = get_k_hamming_neighbours(trainedAndGeneratedS2Codes, binaryS2)  
-            mapPerBatch = get_mAP(neighboursIndices,arguments.k,trainedLabels,list(labels))
+            _, neighboursIndices = indexS2.search(binaryS2, arguments.k)  
+            mapPerBatch = get_mAP_batch(neighboursIndices,arguments.k,trainedLabels,packedLabels,packed=True)
             mapS2toS2 += mapPerBatch
-            mapPerBatch_weighted = get_mAP_weighted(neighboursIndices,arguments.k,trainedLabels,list(labels))
+            mapPerBatch_weighted = get_mAP_weighted_batch(neighboursIndices,arguments.k,trainedLabels,packedLabels,packed=True)
             mapS2toS2_weighted += mapPerBatch_weighted
 
             
@@ -423,10 +414,10 @@ def main():
     
 
 
-    neighboursIndicesS1toS1 = get_k_hamming_neighbours(trainedAndGeneratedS1Codes, test_S1codes[0].reshape(1,-1)) 
-    neighboursIndicesS1toS2 = get_k_hamming_neighbours(trainedAndGeneratedS2Codes, test_S1codes[0].reshape(1,-1)) 
-    neighboursIndicesS2toS1 = get_k_hamming_neighbours(trainedAndGeneratedS1Codes, test_S2codes[0].reshape(1,-1)) 
-    neighboursIndicesS2toS2 = get_k_hamming_neighbours(trainedAndGeneratedS2Codes, test_S2codes[0].reshape(1,-1)) 
+    _, neighboursIndicesS1toS1 = indexS1.search(test_S1codes[0].reshape(1,-1), arguments.k) 
+    _, neighboursIndicesS1toS2 = indexS2.search(test_S1codes[0].reshape(1,-1), arguments.k) 
+    _, neighboursIndicesS2toS1 = indexS1.search(test_S2codes[0].reshape(1,-1), arguments.k) 
+    _, neighboursIndicesS2toS2 = indexS2.search(test_S2codes[0].reshape(1,-1), arguments.k) 
 
 
     
@@ -444,36 +435,39 @@ def main():
         falseRepresentationS1(arguments.S1Dir, trainedS1FileNames[s1toS1Index], os.path.join(result_dir,'S1-S1_{}.tif'.format(i)))
         s2FileName = trainedS1FileNames[s1toS1Index].replace('S1_','')
         createTrueColorTiff(arguments.S2Dir, s2FileName, os.path.join(result_dir,'S1-S1_S2{}.tif'.format(i)))        
-        print('S1-S1 Retrived File Label: ',trainedLabels[s1toS1Index] )
-        printTotalNumberOfClasses(trainedLabels[s1toS1Index])
-        printSharedNumberOfClasses(label_test[0],trainedLabels[s1toS1Index])
+        print('S1-S1 Retrived File Label: ',unpackedLabel(trainedLabels, s1toS1Index, numClasses) )
+        printTotalNumberOfClasses(unpackedLabel(trainedLabels, s1toS1Index, numClasses))
+        printSharedNumberOfClasses(label_test[0],unpackedLabel(trainedLabels, s1toS1Index, numClasses))
         
         
         print('S1-S2 Retrived File Name: ',trainedS2FileNames[s1toS2Index] )
         createTrueColorTiff(arguments.S2Dir, trainedS2FileNames[s1toS2Index], os.path.join(result_dir,'S1-S2_{}.tif'.format(i)))        
-        print('S1-S2 Retrived File Label: ',trainedLabels[s1toS2Index] )
-        printTotalNumberOfClasses(trainedLabels[s1toS2Index])
-        printSharedNumberOfClasses(label_test[0],trainedLabels[s1toS2Index])
+        print('S1-S2 Retrived File Label: ',unpackedLabel(trainedLabels, s1toS2Index, numClasses) )
+        printTotalNumberOfClasses(unpackedLabel(trainedLabels, s1toS2Index, numClasses))
+        printSharedNumberOfClasses(label_test[0],unpackedLabel(trainedLabels, s1toS2Index, numClasses))
 
 
         print('S2-S1 Retrived File Name: ',trainedS1FileNames[s2toS1Index] )
         falseRepresentationS1(arguments.S1Dir, trainedS1FileNames[s2toS1Index], os.path.join(result_dir,'S2-S1_{}.tif'.format(i)))
         s2FileName = trainedS1FileNames[s2toS1Index].replace('S1_','')
         createTrueColorTiff(arguments.S2Dir, s2FileName, os.path.join(result_dir,'S2-S1_S2{}.tif'.format(i)))        
-        print('S2-S1 Retrived File Label: ',trainedLabels[s2toS1Index] )
-        printTotalNumberOfClasses(trainedLabels[s2toS1Index])
-        printSharedNumberOfClasses(label_test[0],trainedLabels[s2toS1Index])
+        print('S2-S1 Retrived File Label: ',unpackedLabel(trainedLabels, s2toS1Index, numClasses) )
+        printTotalNumberOfClasses(unpackedLabel(trainedLabels, s2toS1Index, numClasses))
+        printSharedNumberOfClasses(label_test[0],unpackedLabel(trainedLabels, s2toS1Index, numClasses))
 
 
         print('S2-S2 Retrived File Name: ',trainedS2FileNames[s2toS2Index] )
         createTrueColorTiff(arguments.S2Dir, trainedS2FileNames[s2toS2Index], os.path.join(result_dir,'S2-S2_{}.tif'.format(i)))        
-        print('S2-S2 Retrived File Label: ',trainedLabels[s2toS2Index] )
-        printTotalNumberOfClasses(trainedLabels[s2toS2Index])
-        printSharedNumberOfClasses(label_test[0],trainedLabels[s2toS2Index])
+        print('S2-S2 Retrived File Label: ',unpackedLabel(trainedLabels, s2toS2Index, numClasses) )
+        printTotalNumberOfClasses(unpackedLabel(trainedLabels, s2toS2Index, numClasses))
+        printSharedNumberOfClasses(label_test[0],unpackedLabel(trainedLabels, s2toS2Index, numClasses))
 
             
         
     
+def unpackedLabel(packedLabels, index, numClasses):
+        return unpackCodes(packedLabels[index].unsqueeze(0), numClasses)[0]
+        
 def printTotalNumberOfClasses(tensor):
         ones = (tensor == 1.).sum(dim=0)
         print('Number of Classes: ', ones)
@@ -3,7 +3,6 @@
 # Email: hasanbank@gmail.com
 
 import os
-import numpy as np
 from datetime import datetime
 from tqdm import tqdm
 import time
@@ -13,8 +12,7 @@ from tensorboardX import SummaryWriter
 
 import torch
 import torch.optim as optim
-import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 
@@ -22,9 +20,13 @@ import sys
 sys.path.append('../')
 
 from utils.ResNet import ResNet50_S1, ResNet50_S2
-from utils.dataGenBigEarth import dataGenBigEarthLMDB, ToTensor, Normalize, ConcatDataset
-from utils.metrics import MetricTracker, get_k_hamming_neighbours, get_mAP,get_mAP_weighted, timer,\
-     calculateAverageMetric
+from utils.dataGenBigEarth import dataGenBigEarthLMDB, dataGenBigEarthPairedLMDB, ConcatDataset, DevicePreprocessing, loadChannelStatistics
+from utils.metrics import MetricTracker, averagePrecisions, timer,\
+     meanConfidenceInterval
+from utils.hammingSearch import packCodes, packLabels, packedKNearest, MultiIndexHashing
+from utils.codeArchive import writeCodeArchive, fileHash, ARCHIVE_FILE_NAME
+from utils.checkpointSaver import BackgroundSaver, cpuClone, saveAtomically
+from utils.tripletMining import mineTriplets, MINING_MODES
 
 
 parser = argparse.ArgumentParser(description='PyTorch multi-label Sentinel Images CBIR')
@@ -32,6 +34,8 @@ parser.add_argument('--S1LMDBPth', metavar='DATA_DIR',
                         help='path to the saved sentinel 1 LMDB dataset')
 parser.add_argument('--S2LMDBPth', metavar='DATA_DIR',
                         help='path to the saved sentinel 2 LMDB dataset')
+parser.add_argument('--pairedLMDBPth', metavar='DATA_DIR', default=None,
+                        help='path to the paired sentinel 1 and sentinel 2 LMDB dataset, replaces S1LMDBPth and S2LMDBPth')
 parser.add_argument('-b', '--batch-size', default=200, type=int,
                         metavar='N', help='mini-batch size (default: 200)')
 parser.add_argument('--epochs', type=int, default=500, help='epoch number')
@@ -42,13 +46,32 @@ parser.add_argument('--num_workers', default=8, type=int, metavar='N',
 parser.add_argument('--bits', type=int, default=16, help='number of bits to use in hashing')
 parser.add_argument('--serbia', dest='serbia', action='store_true',
                     help='use the serbia patches')
+parser.add_argument('--batch_upsampling', dest='batch_upsampling', action='store_true',
+                    help='upsample the 20m and 60m bands of whole batches with torch instead of every patch with skimage')
 parser.add_argument('--train_csvS1', metavar='CSV_PTH',
                         help='path to the csv file of train patches')
 parser.add_argument('--val_csvS1', metavar='CSV_PTH',
                         help='path to the csv file of val patches')
 parser.add_argument('--test_csvS1', metavar='CSV_PTH',
                         help='path to the csv file of test patches')
-parser.add_argument('-loss', '--lossFunction', type=str, dest = 'lossFunc', help="which loss function will be used?", choices=['MSELoss', 'TripletLoss'], default='MSELoss')
+parser.add_argument('--val_chunk_size', default=1024, type=int, metavar='N',
+                        help='number of validation queries searched at once in leave-one-out retrieval')
+parser.add_argument('--val_every', default=1, type=int, metavar='N',
+                        help='validate every N epochs and after the last epoch (default: 1)')
+parser.add_argument('--val_subset', default=0, type=int, metavar='N',
+                        help='number of fixed random validation queries of intermediate validations, 0 for all queries. '
+                             'All queries are evaluated after the last epoch and when the subset mAP beats the best mAP')
+parser.add_argument('--amp', dest='amp', action='store_true',
+                    help='mixed precision training, float16 autocast with gradient scaling on GPU and bfloat16 autocast on CPU')
+parser.add_argument('--channels_last', dest='channels_last', action='store_true',
+                    help='run the models and their inputs in the channels_last memory format')
+parser.add_argument('--resume', default='', type=str, metavar='PATH',
+                    help='continue training from the last or best checkpoint of a previous run')
+parser.add_argument('--snapshot_every', default=10, type=int, metavar='N',
+                    help='write the <name>_last checkpoint every N epochs (default: 10)')
+parser.add_argument('-loss', '--lossFunction', type=str, dest = 'lossFunc', help="which loss function will be used?", choices=['MSELoss', 'PairwiseMatrix', 'TripletLoss'], default='MSELoss')
+parser.add_argument('--triplet_mining', type=str, choices=MINING_MODES, default='label',
+                    help='triplet mining of the TripletLoss: label (nearest and farthest labels), semihard or hard (by the code distances)')
 
 
 args = parser.parse_args()
@@ -80,24 +103,25 @@ def write_arguments_to_file(args, filename):
 
 def save_checkpoint(state, name):
     filename = os.path.join(checkpoint_dir, name + '_checkpoint.pth.tar')
-    torch.save(state, filename)
+    return saveAtomically(state, filename)
 
 
-def get_triplets(train_labels):
-    indices = get_k_hamming_neighbours(train_labels,train_labels)
+def save_best(state, S1Codes, S2Codes, labels, S1Names, S2Names, sv_name):
+    """
+    checkpoint of the best epoch together with the code archive and the indexes of its validation codes
+    """
+    dataset_folder = os.path.join(dataset_dir,sv_name)
+    if not os.path.isdir(dataset_folder):
+        os.makedirs(dataset_folder)
     
-    anchors = indices[:,0]
-    anchors = anchors.reshape(1,-1)
+    checkpointFile = save_checkpoint(state, sv_name)
     
-    positives = indices[:,1]
-    positives = positives.reshape(1,-1)
-    
-    negatives = indices[:,-1]
-    negatives = negatives.reshape(1,-1)
-    
-    triplets = torch.cat((anchors,positives,negatives))
-    
-    return triplets
+    writeCodeArchive(os.path.join(dataset_folder, ARCHIVE_FILE_NAME),
+                     S1Codes, S2Codes, labels, S1Names, S2Names,
+                     args.bits, epoch=state['epoch'], checkpointHash=fileHash(checkpointFile))
+
+    MultiIndexHashing(S1Codes).save(os.path.join(dataset_folder, 'mihS1Index.npz'))
+    MultiIndexHashing(S2Codes).save(os.path.join(dataset_folder, 'mihS2Index.npz'))
 
 
 #Binarization Loss
@@ -171,6 +195,43 @@ def balancingLossInMSE(logitS1_1,logitS1_2, logitS2_1, logitS2_2):
     
     
 
+def autocast(device):
+    """
+    autocast context of the forward passes with --amp, the logits are cast back to float32 for the losses
+    """
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=args.amp)
+
+
+def pairwiseMatrixLoss(logitsS1, logitsS2, labels):
+    """
+    MSE between the code cosines and the label cosines of all B x B pairs of the batch, within both modalities
+    and across them. Every cosine matrix is one matmul of the row normalized logits or labels.
+    The weights follow the MSE loss: 0.33 for each modality, 0.165 for the cross-modal pairs of the same patch
+    (target 1) and 0.165 for the cross-modal pairs of different patches.
+    """
+    labels = nn.functional.normalize(labels.float(), dim=1)
+    codesS1 = nn.functional.normalize(logitsS1, dim=1)
+    codesS2 = nn.functional.normalize(logitsS2, dim=1)
+    
+    cosBetweenLabels = labels @ labels.t()
+    cosBetweenS1 = codesS1 @ codesS1.t()
+    cosBetweenS2 = codesS2 @ codesS2.t()
+    cosInter = codesS1 @ codesS2.t()
+    
+    #the diagonal of the intra-modal matrices is 1 for codes and labels alike
+    offDiagonal = ~torch.eye(labels.size(0), dtype=torch.bool, device=labels.device)
+    numPairs = max(labels.size(0) * (labels.size(0) - 1), 1)
+    
+    S1IntraLoss = ((cosBetweenS1 - cosBetweenLabels) ** 2)[offDiagonal].sum() / numPairs
+    S2IntraLoss = ((cosBetweenS2 - cosBetweenLabels) ** 2)[offDiagonal].sum() / numPairs
+    
+    InterLoss_SameLabel = ((torch.diagonal(cosInter) - 1) ** 2).mean()
+    InterLoss_DifLabel = ((cosInter - cosBetweenLabels) ** 2)[offDiagonal].sum() / numPairs
+    
+    return 0.33 * S1IntraLoss + 0.33 * S2IntraLoss + 0.165 * InterLoss_SameLabel + 0.165 * InterLoss_DifLabel
+
+
 def triplet_loss(a, p, n, margin=0.2) : 
     d = nn.PairwiseDistance(p=2)
     distance = d(a, p) - d(a, n) + margin 
@@ -185,6 +246,13 @@ def main():
 
     sv_name = datetime.strftime(datetime.now(), '%Y%m%d_%H%M%S')
     sv_name = sv_name + '_' + str(args.bits) + '_' + str(args.k) + '_' + args.lossFunc
+    
+    checkpoint = None
+    if args.resume:
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        #checkpoints of older runs do not have the name, their files are continued under a new one
+        sv_name = checkpoint.get('sv_name', sv_name)
+        print("=> resuming '{}' after epoch {}".format(args.resume, checkpoint['epoch']))
     print('saving file name is ', sv_name)
 
     write_arguments_to_file(args, os.path.join(logs_dir, sv_name+'_arguments.txt'))
@@ -193,47 +261,8 @@ def main():
     resultsFile_name = os.path.join(result_dir, sv_name+'_results.txt')
     
 
-    if args.serbia:
-
-            #Sentinel 2 in Serbia Statistics
-            bands_mean = {
-                            'bands10_mean': [ 458.93423 ,  676.8278,  665.719, 2590.4482],
-                            'bands20_mean': [ 1065.233, 2068.3826, 2435.3057, 2647.92, 2010.1838, 1318.5911],
-                            'bands60_mean': [ 341.05457, 2630.7898 ],
-                        }
-        
-            bands_std = {
-                            'bands10_std': [ 315.86624,  305.07462,  302.11145, 310.93375],
-                            'bands20_std': [ 288.43314, 287.29364, 299.83383, 295.51282, 211.81876,  193.92213],
-                            'bands60_std': [ 267.79263, 292.94092 ]
-                    }
-            #Sentinel 1 in Serbia Statistics
-            polars_mean = {
-                    'polarVH_mean': [ -15.827944 ],
-                    'polarVV_mean': [ -9.317011]
-                }
-
-            polars_std = {
-                    'polarVH_std': [ 0.782826 ],
-                    'polarVV_std': [ 1.8147297]
-            }
-            
-       
-    else:
-
-        bands_mean = {
-                'bands10_mean': [ 429.9430203 ,  614.21682446,  590.23569706, 2218.94553375],
-                'bands20_mean': [ 950.68368468, 1792.46290469, 2075.46795189, 2266.46036911, 1594.42694882, 1009.32729131],
-                'bands60_mean': [ 340.76769064, 2246.0605464 ],
-                    }
-    
-        bands_std = {
-                'bands10_std': [ 572.41639287,  582.87945694,  675.88746967, 1365.45589904],
-                'bands20_std': [ 729.89827633, 1096.01480586, 1273.45393088, 1356.13789355, 1079.19066363,  818.86747235],
-                'bands60_std': [ 554.81258967, 1302.3292881 ]
-                    }
-                
-                
+    #statistics computed by prep_splits, literals for LMDB files written without them
+    channels_mean, channels_std = loadChannelStatistics([args.S1LMDBPth, args.S2LMDBPth, args.pairedLMDBPth], args.train_csvS1, args.serbia)
 
 
     modelS1 = ResNet50_S1(args.bits)
@@ -243,81 +272,96 @@ def main():
     if torch.cuda.is_available():
         torch.backends.cudnn.enabled = True
         cudnn.benchmark = True
-        modelS1.cuda()
-        modelS2.cuda()
-        gpuDisabled = False
+        device = torch.device("cuda")
     else:
-        modelS1.cpu()
-        modelS2.cpu()
-        gpuDisabled = True
+        device = torch.device("cpu")
+    
+    memoryFormat = torch.channels_last if args.channels_last else torch.contiguous_format
+    
+    modelS1.to(device, memory_format=memoryFormat)
+    modelS2.to(device, memory_format=memoryFormat)
         
-    print('GPU Disabled: ',gpuDisabled)
-
-
-
-    train_dataGenS1 =  dataGenBigEarthLMDB(
-                    bigEarthPthLMDB=args.S1LMDBPth,
-                    isSentinel2 = False,
-                    state='train',
-                    imgTransform=transforms.Compose([
-                        ToTensor(isSentinel2 = False),
-                        Normalize(polars_mean, polars_std, False)
-                    ]),
-                    upsampling=False,
-                    train_csv=args.train_csvS1,
-                    val_csv=args.val_csvS1,
-                    test_csv=args.test_csvS1
-    )
+    print('Device: ',device)
+    
+    #the data loaders deliver raw batches, they are normalized and concatenated on the device
+    preprocess = DevicePreprocessing(channels_mean, channels_std, device, memoryFormat)
+    
+    #bfloat16 has the exponent range of float32, only float16 gradients need scaling
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and device.type == 'cuda')
+
+
+
+    if args.pairedLMDBPth is not None:
+        #both modalities of a patch are read from one value of the paired LMDB file
+        train_dataset = dataGenBigEarthPairedLMDB(
+                        pairedPthLMDB=args.pairedLMDBPth,
+                        state='train',
+                        upsampling=not args.batch_upsampling,
+                        train_csv=args.train_csvS1,
+                        val_csv=args.val_csvS1,
+                        test_csv=args.test_csvS1
+        )
+
+        val_dataset = dataGenBigEarthPairedLMDB(
+                        pairedPthLMDB=args.pairedLMDBPth,
+                        state='val',
+                        upsampling=not args.batch_upsampling,
+                        train_csv=args.train_csvS1,
+                        val_csv=args.val_csvS1,
+                        test_csv=args.test_csvS1
+        )
+    else:
+        train_dataGenS1 =  dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=args.S1LMDBPth,
+                        isSentinel2 = False,
+                        state='train',
+                        upsampling=False,
+                        train_csv=args.train_csvS1,
+                        val_csv=args.val_csvS1,
+                        test_csv=args.test_csvS1
+        )
         
-    train_dataGenS2 = dataGenBigEarthLMDB(
-                    bigEarthPthLMDB=args.S2LMDBPth,
-                    isSentinel2 = True,
-                    state='train',
-                    imgTransform=transforms.Compose([
-                        ToTensor(isSentinel2=True),
-                        Normalize(bands_mean, bands_std,True)
-                    ]),
-                    upsampling=True,
-                    train_csv=args.train_csvS1,
-                    val_csv=args.val_csvS1,
-                    test_csv=args.test_csvS1
-    )
-
-    val_dataGenS1 = dataGenBigEarthLMDB(
-                    bigEarthPthLMDB=args.S1LMDBPth,
-                    isSentinel2 = False,
-                    state='val',
-                    imgTransform=transforms.Compose([
-                        ToTensor(False),
-                        Normalize(polars_mean, polars_std,False)
-                    ]),
-                    upsampling=False,
-                    train_csv=args.train_csvS1,
-                    val_csv=args.val_csvS1,
-                    test_csv=args.test_csvS1
-    )
-    
-    val_dataGenS2 = dataGenBigEarthLMDB(
-                    bigEarthPthLMDB=args.S2LMDBPth,
-                    isSentinel2 = True,
-                    state='val',
-                    imgTransform=transforms.Compose([
-                        ToTensor(True),
-                        Normalize(bands_mean, bands_std,True)
-                    ]),
-                    upsampling=True,
-                    train_csv=args.train_csvS1,
-                    val_csv=args.val_csvS1,
-                    test_csv=args.test_csvS1
-    )
-    
+        train_dataGenS2 = dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=args.S2LMDBPth,
+                        isSentinel2 = True,
+                        state='train',
+                        upsampling=not args.batch_upsampling,
+                        train_csv=args.train_csvS1,
+                        val_csv=args.val_csvS1,
+                        test_csv=args.test_csvS1
+        )
+
+        val_dataGenS1 = dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=args.S1LMDBPth,
+                        isSentinel2 = False,
+                        state='val',
+                        upsampling=False,
+                        train_csv=args.train_csvS1,
+                        val_csv=args.val_csvS1,
+                        test_csv=args.test_csvS1
+        )
+    
+        val_dataGenS2 = dataGenBigEarthLMDB(
+                        bigEarthPthLMDB=args.S2LMDBPth,
+                        isSentinel2 = True,
+                        state='val',
+                        upsampling=not args.batch_upsampling,
+                        train_csv=args.train_csvS1,
+                        val_csv=args.val_csvS1,
+                        test_csv=args.test_csvS1
+        )
+
+        train_dataset = ConcatDataset(train_dataGenS1,train_dataGenS2)
+        val_dataset = ConcatDataset(val_dataGenS1,val_dataGenS2)
+    
+    #the datasets read whole minibatches of the batch samplers in one transaction each
     train_data_loader = DataLoader(
-            ConcatDataset(train_dataGenS1,train_dataGenS2),
-            batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True, pin_memory=True)
+            train_dataset, sampler=BatchSampler(RandomSampler(train_dataset), args.batch_size, drop_last=False),
+            batch_size=None, num_workers=args.num_workers, pin_memory=True)
 
     val_data_loader = DataLoader(
-            ConcatDataset(val_dataGenS1,val_dataGenS2),
-            batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False, pin_memory=True)    
+            val_dataset, sampler=BatchSampler(SequentialSampler(val_dataset), args.batch_size, drop_last=False),
+            batch_size=None, num_workers=args.num_workers, pin_memory=True)    
     
     
 
@@ -331,9 +375,46 @@ def main():
     val_writer = SummaryWriter(os.path.join(logs_dir, 'runs', sv_name, 'val'))
 
 
-    toWrite = False
     best_averageMAP = 0
     start_epoch = 0
+    
+    if checkpoint is not None:
+        modelS1.load_state_dict(checkpoint['state_dictS1'])
+        modelS2.load_state_dict(checkpoint['state_dictS2'])
+        optimizerS1.load_state_dict(checkpoint['optimizerS1'])
+        optimizerS2.load_state_dict(checkpoint['optimizerS2'])
+        #the scaler state is only saved by runs with --amp on CUDA
+        if checkpoint.get('scaler') and scaler.is_enabled():
+            scaler.load_state_dict(checkpoint['scaler'])
+        best_averageMAP = checkpoint['best_map']
+        start_epoch = checkpoint['epoch'] + 1
+        
+        #a best epoch after the last snapshot has already been written, it must not be replaced by a worse one
+        bestCheckpointFile = os.path.join(checkpoint_dir, sv_name + '_checkpoint.pth.tar')
+        if os.path.isfile(bestCheckpointFile):
+            best_averageMAP = max(best_averageMAP, torch.load(bestCheckpointFile, map_location='cpu')['best_map'])
+    
+    def trainingState(epoch):
+        #copied to the CPU before the next optimizer step, the saver thread writes the copy
+        return cpuClone({
+            'epoch': epoch,
+            'sv_name': sv_name,
+            'state_dictS1': modelS1.state_dict(),
+            'state_dictS2': modelS2.state_dict(),
+            'optimizerS1': optimizerS1.state_dict(),
+            'optimizerS2': optimizerS2.state_dict(),
+            'scaler': scaler.state_dict() if scaler.is_enabled() else None,
+            'best_map': best_averageMAP,
+        })
+    
+    saver = BackgroundSaver()
+    
+    #queries of the leave-one-out validation retrieval, the subset is drawn once so the epochs stay comparable
+    valIndices = torch.arange(len(val_dataset), device=device)
+    valSubsetIndices = None
+    if 0 < args.val_subset < len(val_dataset):
+        generator = torch.Generator().manual_seed(0)
+        valSubsetIndices = torch.randperm(len(val_dataset), generator=generator)[:args.val_subset].sort()[0].to(device)
 
     start = time.time()
     for epoch in range(start_epoch, args.epochs):
@@ -348,53 +429,38 @@ def main():
 
 
 
-        train(train_data_loader, modelS1,modelS2, optimizerS1,optimizerS2, epoch, train_writer,gpuDisabled,resultsFile_name)
-                        
-        averageMAP,val_S1codes,val_S2codes,label_val,name_valS1,name_valS2 = val(val_data_loader, modelS1,modelS2, optimizerS1,optimizerS2, val_writer,gpuDisabled,resultsFile_name)
-        
-        val_S1codes = torch.stack(val_S1codes).reshape(len(val_S1codes),args.bits)
-        val_S2codes = torch.stack(val_S2codes).reshape(len(val_S2codes),args.bits)
-        label_val = torch.stack(label_val,0)
-
-
-
-
-        is_best_acc = averageMAP > best_averageMAP
-        best_averageMAP = max(best_averageMAP, averageMAP)
-        
-        print('is_best_acc: ',is_best_acc)
+        train(train_data_loader, modelS1,modelS2, optimizerS1,optimizerS2, scaler, epoch, train_writer,preprocess,resultsFile_name)
         
-        with open(resultsFile_name, 'a') as resultsFile:
-                resultsFile.write( 'Best Epoch: {}\n '.format(is_best_acc))
-                
-
-        if is_best_acc:
-                            
-            generatedS1CodesToWriteFile = []
-            generatedS2CodesToWriteFile = []
-            trainedLabelsToWriteFile = []
-            trainedS1FileNamesToWriteFile = []    
-            trainedS2FileNamesToWriteFile = []  
-            
-            
-            generatedS1CodesToWriteFile =  val_S1codes
-            generatedS2CodesToWriteFile = val_S2codes
+        lastEpoch = epoch == args.epochs - 1
+        if (epoch + 1) % args.val_every == 0 or lastEpoch:
+            val_S1codes,val_S2codes,label_val,name_valS1,name_valS2 = val(val_data_loader, modelS1,modelS2, preprocess)
+            
+            if valSubsetIndices is not None and not lastEpoch:
+                averageMAP = evaluate(val_S1codes,val_S2codes,label_val, valSubsetIndices, epoch, val_writer,resultsFile_name)
+                if averageMAP > best_averageMAP:
+                    print('subset mAP beats the best mAP, evaluating all queries')
+                    averageMAP = evaluate(val_S1codes,val_S2codes,label_val, valIndices, epoch, val_writer,resultsFile_name)
+            else:
+                averageMAP = evaluate(val_S1codes,val_S2codes,label_val, valIndices, epoch, val_writer,resultsFile_name)
+    
+            is_best_acc = averageMAP > best_averageMAP
+            best_averageMAP = max(best_averageMAP, averageMAP)
             
-            trainedLabelsToWriteFile = label_val
+            print('is_best_acc: ',is_best_acc)
             
-            trainedS1FileNamesToWriteFile = name_valS1
-            trainedS2FileNamesToWriteFile = name_valS2
-
-            epochToWrite = epoch
-            stateS1DictToWrite = modelS1.state_dict()
-            stateS2DictToWrite = modelS2.state_dict()
-
-            optimizerS1ToWrite = optimizerS1.state_dict()
-            optimizerS2ToWrite = optimizerS2.state_dict()
-
-            bestF1ToWrite = best_averageMAP
-            toWrite = True
+            with open(resultsFile_name, 'a') as resultsFile:
+                    resultsFile.write( 'Best Epoch: {}\n '.format(is_best_acc))
+                    
+    
+            if is_best_acc:
+                saver.submit(save_best, trainingState(epoch), val_S1codes.cpu(), val_S2codes.cpu(), label_val.cpu(),
+                             name_valS1, name_valS2, sv_name)
+        
+        if (epoch + 1) % args.snapshot_every == 0 or epoch == args.epochs - 1:
+            saver.submit(save_checkpoint, trainingState(epoch), sv_name + '_last')
 
+    saver.close()
+    
     end = time.time()
     print('Training and Validation Time has been elapsed')
     print(timer(start,end))
@@ -404,44 +470,9 @@ def main():
     
     
     
-    if toWrite :
-        
-        
-        dataset_folder = os.path.join(dataset_dir,sv_name)
-        if not os.path.isdir(dataset_folder):
-            os.makedirs(dataset_folder)
-        
-        fileGeneratedS1Codes = os.path.join(dataset_folder, 'generatedS1Codes.pt')
-        fileGeneratedS2Codes = os.path.join(dataset_folder, 'generatedS2Codes.pt')
-
-        fileTrainedS1Names = os.path.join(dataset_folder, 'trainedS1Names.npy')
-        fileTrainedS2Names = os.path.join(dataset_folder, 'trainedS2Names.npy')
 
-        fileTrainedLabels = os.path.join(dataset_folder,'trainedLabels.pt')
 
-
-        torch.save(generatedS1CodesToWriteFile,fileGeneratedS1Codes)
-        torch.save(generatedS2CodesToWriteFile,fileGeneratedS2Codes)
-        
-        np.save(fileTrainedS1Names, trainedS1FileNamesToWriteFile )
-        np.save(fileTrainedS2Names, trainedS2FileNamesToWriteFile )
-
-        torch.save(trainedLabelsToWriteFile, fileTrainedLabels)
-        
-        save_checkpoint({
-            'epoch': epochToWrite,
-            'state_dictS1': stateS1DictToWrite,
-            'state_dictS2': stateS2DictToWrite,
-            'optimizerS1': optimizerS1ToWrite,
-            'optimizerS2': optimizerS2ToWrite,
-            'best_map': bestF1ToWrite,
-        }, sv_name)
-        
-        
-    
-
-
-def train(trainloader, modelS1,modelS2, optimizerS1,optimizerS2, epoch, train_writer,gpuDisabled,resultsFile_name):
+def train(trainloader, modelS1,modelS2, optimizerS1,optimizerS2, scaler, epoch, train_writer,preprocess,resultsFile_name):
 
      
     lossTracker = MetricTracker()
@@ -452,47 +483,29 @@ def train(trainloader, modelS1,modelS2, optimizerS1,optimizerS2, epoch, train_wr
     for idx, (dataS1,dataS2) in enumerate(tqdm(trainloader, desc="training")):
         numSample = dataS2["bands10"].size(0)
         
-        if not args.lossFunc == 'TripletLoss':
+        if args.lossFunc == 'MSELoss':
             lossFunc = nn.MSELoss()
             
             halfNumSample = numSample // 2
             
-            if gpuDisabled :
-                bands1 = torch.cat((dataS2["bands10"][:halfNumSample], dataS2["bands20"][:halfNumSample],dataS2["bands60"][:halfNumSample]), dim=1).to(torch.device("cpu"))
-                polars1 = torch.cat((dataS1["polarVH"][:halfNumSample], dataS1["polarVV"][:halfNumSample]), dim=1).to(torch.device("cpu"))
-                labels1 = dataS2["label"][:halfNumSample].to(torch.device("cpu")) 
-                
-                bands2 = torch.cat((dataS2["bands10"][halfNumSample:], dataS2["bands20"][halfNumSample:],dataS2["bands60"][halfNumSample:]), dim=1).to(torch.device("cpu"))
-                polars2 = torch.cat((dataS1["polarVH"][halfNumSample:], dataS1["polarVV"][halfNumSample:]), dim=1).to(torch.device("cpu"))
-                labels2 = dataS2["label"][halfNumSample:].to(torch.device("cpu")) 
-                
-                labels = torch.cat((labels1,labels2)).to(torch.device('cpu'))
-                
-                onesTensor = torch.ones(halfNumSample)
-                
-            else:
-                bands1 = torch.cat((dataS2["bands10"][:halfNumSample], dataS2["bands20"][:halfNumSample],dataS2["bands60"][:halfNumSample]), dim=1).to(torch.device("cuda"))
-                polars1 = torch.cat((dataS1["polarVH"][:halfNumSample], dataS1["polarVV"][:halfNumSample]), dim=1).to(torch.device("cuda"))
-                labels1 = dataS2["label"][:halfNumSample].to(torch.device("cuda")) 
-                
-                bands2 = torch.cat((dataS2["bands10"][halfNumSample:], dataS2["bands20"][halfNumSample:],dataS2["bands60"][halfNumSample:]), dim=1).to(torch.device("cuda"))
-                polars2 = torch.cat((dataS1["polarVH"][halfNumSample:], dataS1["polarVV"][halfNumSample:]), dim=1).to(torch.device("cuda"))
-                labels2 = dataS2["label"][halfNumSample:].to(torch.device("cuda")) 
-                
-                labels = torch.cat((labels1,labels2)).to(torch.device('cuda'))
+            polars, bands, labels = preprocess(dataS1, dataS2)
+            
+            labels1, labels2 = labels[:halfNumSample], labels[halfNumSample:]
                 
-                onesTensor = torch.cuda.FloatTensor(halfNumSample).fill_(0)
+            onesTensor = torch.ones(halfNumSample, device=labels.device)
             
                     
             
             optimizerS1.zero_grad()
             optimizerS2.zero_grad()
             
-            logitsS1_1 = modelS1(polars1)
-            logitsS1_2 = modelS1(polars2)
+            #one forward pass per modality over the whole batch, the pairs are formed from the halves of the logits
+            with autocast(polars.device):
+                logitsS1 = modelS1(polars)
+                logitsS2 = modelS2(bands)
             
-            logitsS2_1 = modelS2(bands1)
-            logitsS2_2 = modelS2(bands2)
+            logitsS1_1, logitsS1_2 = logitsS1.float()[:halfNumSample], logitsS1.float()[halfNumSample:]
+            logitsS2_1, logitsS2_2 = logitsS2.float()[:halfNumSample], logitsS2.float()[halfNumSample:]
     
     
             cos = torch.nn.CosineSimilarity(dim=1)
@@ -527,31 +540,44 @@ def train(trainloader, modelS1,modelS2, optimizerS1,optimizerS2, epoch, train_wr
             loss = mseLoss - beta * pushLossValue / args.bits + gamma * balancingLossValue
             
        
-        
+        elif args.lossFunc == 'PairwiseMatrix':
+            polars, bands, labels = preprocess(dataS1, dataS2)
+                
+            optimizerS1.zero_grad()
+            optimizerS2.zero_grad()
+            
+            with autocast(polars.device):
+                logitsS1 = modelS1(polars)
+                logitsS2 = modelS2(bands)
+            
+            logitsS1, logitsS2 = logitsS1.float(), logitsS2.float()
+            
+            
+            pushLossValue = pushLoss(logitsS1,logitsS2)
+            balancingLossValue = balancingLoss(logitsS1,logitsS2)
+            
+            pairwiseLoss = pairwiseMatrixLoss(logitsS1, logitsS2, labels)
+            
+            loss = pairwiseLoss - beta * pushLossValue / args.bits + gamma * balancingLossValue
+            
        
         else:
-            if gpuDisabled :
-                bands = torch.cat((dataS2["bands10"], dataS2["bands20"],dataS2["bands60"]), dim=1).to(torch.device("cpu"))
-                polars = torch.cat((dataS1["polarVH"], dataS1["polarVV"]), dim=1).to(torch.device("cpu"))
-                labels = dataS2["label"].to(torch.device("cpu")) 
-                
-            else:            
-                bands = torch.cat((dataS2["bands10"], dataS2["bands20"],dataS2["bands60"]), dim=1).to(torch.device("cuda"))
-                polars = torch.cat((dataS1["polarVH"], dataS1["polarVV"]), dim=1).to(torch.device("cuda"))
-                labels = dataS2["label"].to(torch.device("cuda")) 
+            polars, bands, labels = preprocess(dataS1, dataS2)
                 
             optimizerS1.zero_grad()
             optimizerS2.zero_grad()
             
-            logitsS1 = modelS1(polars)
-            logitsS2 = modelS2(bands)
+            with autocast(polars.device):
+                logitsS1 = modelS1(polars)
+                logitsS2 = modelS2(bands)
             
+            logitsS1, logitsS2 = logitsS1.float(), logitsS2.float()
             
             pushLossValue = pushLoss(logitsS1,logitsS2)
             balancingLossValue = balancingLoss(logitsS1,logitsS2)
             
 
-            triplets = get_triplets(labels)
+            triplets = mineTriplets(labels, logitsS1, logitsS2, args.triplet_mining)
             
             S1IntraLoss = triplet_loss(logitsS1[triplets[0]], logitsS1[triplets[1]], logitsS1[triplets[2]] )
             S2IntraLoss = triplet_loss(logitsS2[triplets[0]], logitsS2[triplets[1]], logitsS2[triplets[2]] )
@@ -566,9 +592,10 @@ def train(trainloader, modelS1,modelS2, optimizerS1,optimizerS2, epoch, train_wr
             
                     
             
-        loss.backward()
-        optimizerS1.step()
-        optimizerS2.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizerS1)
+        scaler.step(optimizerS2)
+        scaler.update()
         
 
         lossTracker.update(loss.item(), numSample)
@@ -583,8 +610,28 @@ def train(trainloader, modelS1,modelS2, optimizerS1,optimizerS2, epoch, train_wr
     
     
 
-def val(valloader, modelS1,modelS2, optimizerS1,optimizerS2, val_writer, gpuDisabled,resultsFile_name):
+def leaveOneOutAPs(packedQueryCodes, packedDatabaseCodes, labels, queryIndices):
+    """
+    average precisions and weighted average precisions of the items queryIndices, every query retrieves
+    from all other items, the item itself is masked out
+    """
+    aps = []
+    aps_weighted = []
+    
+    for start in range(0, len(queryIndices), args.val_chunk_size):
+        chunkIndices = queryIndices[start:start + args.val_chunk_size]
+        
+        _, neighboursIndices = packedKNearest(packedDatabaseCodes, packedQueryCodes[chunkIndices], args.k, excludeIndices=chunkIndices)
+        aps.append(averagePrecisions(neighboursIndices,args.k,labels,labels[chunkIndices],packed=True))
+        aps_weighted.append(averagePrecisions(neighboursIndices,args.k,labels,labels[chunkIndices],weighted=True,packed=True))
+    
+    return torch.cat(aps), torch.cat(aps_weighted)
+    
 
+def val(valloader, modelS1,modelS2, preprocess):
+    """
+    binary codes, labels and patch names of all validation items
+    """
 
     modelS1.eval()
     modelS2.eval()
@@ -595,33 +642,10 @@ def val(valloader, modelS1,modelS2, optimizerS1,optimizerS2, val_writer, gpuDisa
     name_valS1 = []
     name_valS2 = []
     
-    mapS1toS1 = 0
-    mapS1toS2 = 0
-    mapS2toS1 = 0
-    mapS2toS2 = 0
-    
-    mapS1toS1_weighted = 0
-    mapS1toS2_weighted = 0
-    mapS2toS1_weighted = 0
-    mapS2toS2_weighted = 0
-
-    
-    
-    totalSize = 0 
-
     with torch.no_grad():
         for batch_idx, (dataS1,dataS2) in enumerate(tqdm(valloader, desc="validation")):
 
-            totalSize += dataS2["bands10"].size(0)
-            
-            if gpuDisabled:
-                bands = torch.cat((dataS2["bands10"], dataS2["bands20"],dataS2["bands60"]), dim=1).to(torch.device("cpu"))
-                polars = torch.cat((dataS1["polarVH"], dataS1["polarVV"]), dim=1).to(torch.device("cpu"))
-                labels = dataS1["label"].to(torch.device("cpu"))  
-            else:
-                bands = torch.cat((dataS2["bands10"], dataS2["bands20"],dataS2["bands60"]), dim=1).to(torch.device("cuda"))
-                polars = torch.cat((dataS1["polarVH"], dataS1["polarVV"]), dim=1).to(torch.device("cuda"))
-                labels = dataS1["label"].to(torch.device("cuda")) 
+            polars, bands, labels = preprocess(dataS1, dataS2)
                 
 
             logitsS1 = modelS1(polars)
@@ -631,78 +655,53 @@ def val(valloader, modelS1,modelS2, optimizerS1,optimizerS2, val_writer, gpuDisa
             binaryS1 = (torch.sign(logitsS1 - 0.5) + 1 ) / 2
             binaryS2 = (torch.sign(logitsS2 - 0.5) + 1 ) / 2
 
-            predicted_S1codes += list(binaryS1)
-            predicted_S2codes += list(binaryS2)
+            predicted_S1codes.append(binaryS1)
+            predicted_S2codes.append(binaryS2)
                         
-            label_val += list(labels)
+            label_val.append(labels)
             name_valS1 += list(dataS1['patchName'])
             name_valS2 += list(dataS2['patchName'])
-            
     
+    return torch.cat(predicted_S1codes),torch.cat(predicted_S2codes),torch.cat(label_val),name_valS1,name_valS2
     
     
+def evaluate(valCodesS1, valCodesS2, valLabels, queryIndices, epoch, val_writer, resultsFile_name):
+    """
+    leave-one-out mAP and weighted mAP of the four retrieval directions for the validation queries queryIndices,
+    the average mAP of a query subset is reported with its 95% confidence interval
+    :return: average mAP of the four directions
+    """
+    packedValS1 = packCodes(valCodesS1)
+    packedValS2 = packCodes(valCodesS2)
+    packedLabels = packLabels(valLabels)
     
-    valCodesS1 = torch.stack(predicted_S1codes).reshape(len(predicted_S1codes),args.bits)
-    valCodesS2 = torch.stack(predicted_S2codes).reshape(len(predicted_S2codes),args.bits)
-    valLabels = torch.stack(label_val).reshape(len(label_val),len(label_val[0]))
-    
-    for i in range(len(valCodesS1)):
-        
-        queryCodeS1 = valCodesS1[i].reshape(1,-1)
-        queryCodeS2 = valCodesS2[i].reshape(1,-1)
-        queryLabel = label_val[i]
-                
-        databaseS1 = valCodesS1
-        databaseS2 = valCodesS2
-        databaseLabels = valLabels
-        
-        databaseS1 = torch.cat([databaseS1[0:i], databaseS1[i+1:]])
-        databaseS2 = torch.cat([databaseS2[0:i], databaseS2[i+1:]])
-        databaseLabels = torch.cat([databaseLabels[0:i], databaseLabels[i+1:]])
-        
-        #S1 to S1
-        neighboursIndices = get_k_hamming_neighbours(databaseS1, queryCodeS1)  
-        mapPerBatch = get_mAP(neighboursIndices,args.k,databaseLabels,queryLabel)
-        mapPerBatch_Weighted = get_mAP_weighted(neighboursIndices,args.k,databaseLabels,queryLabel)
-        mapS1toS1 += mapPerBatch
-        mapS1toS1_weighted += mapPerBatch_Weighted
-        
-        #S1 to S2
-        neighboursIndices = get_k_hamming_neighbours(databaseS2,queryCodeS1)  
-        mapPerBatch = get_mAP(neighboursIndices,args.k,databaseLabels,queryLabel)
-        mapPerBatch_weighted = get_mAP_weighted(neighboursIndices,args.k,databaseLabels,queryLabel)
-        mapS1toS2 += mapPerBatch
-        mapS1toS2_weighted += mapPerBatch_weighted
+    apS1toS1, apS1toS1_weighted = leaveOneOutAPs(packedValS1, packedValS1, packedLabels, queryIndices)
+    apS1toS2, apS1toS2_weighted = leaveOneOutAPs(packedValS1, packedValS2, packedLabels, queryIndices)
+    apS2toS1, apS2toS1_weighted = leaveOneOutAPs(packedValS2, packedValS1, packedLabels, queryIndices)
+    apS2toS2, apS2toS2_weighted = leaveOneOutAPs(packedValS2, packedValS2, packedLabels, queryIndices)
 
-        
-            
-        #S2 to S1
-        neighboursIndices = get_k_hamming_neighbours(databaseS1,queryCodeS2)  
-        mapPerBatch = get_mAP(neighboursIndices,args.k,databaseLabels,queryLabel)
-        mapPerBatch_weighted = get_mAP_weighted(neighboursIndices,args.k,databaseLabels,queryLabel)
-        mapS2toS1 += mapPerBatch
-        mapS2toS1_weighted += mapPerBatch_weighted
-                  
-        #S2 to S2
-        neighboursIndices = get_k_hamming_neighbours(databaseS2, queryCodeS2)  
-        mapPerBatch = get_mAP(neighboursIndices,args.k,databaseLabels,queryLabel)
-        mapPerBatch_weighted = get_mAP_weighted(neighboursIndices,args.k,databaseLabels,queryLabel)
-        mapS2toS2 += mapPerBatch
-        mapS2toS2_weighted += mapPerBatch_weighted
-
-
-    mapS1toS1 = calculateAverageMetric(mapS1toS1,totalSize)
-    mapS1toS2 = calculateAverageMetric(mapS1toS2,totalSize)
-    mapS2toS1 = calculateAverageMetric(mapS2toS1,totalSize)
-    mapS2toS2 = calculateAverageMetric(mapS2toS2,totalSize)
-    averageMap = (mapS1toS1 + mapS1toS2 + mapS2toS1 + mapS2toS2 ) / 4   
-    
-    mapS1toS1_weighted = calculateAverageMetric(mapS1toS1_weighted,totalSize)
-    mapS1toS2_weighted = calculateAverageMetric(mapS1toS2_weighted,totalSize)
-    mapS2toS1_weighted = calculateAverageMetric(mapS2toS1_weighted,totalSize)
-    mapS2toS2_weighted = calculateAverageMetric(mapS2toS2_weighted,totalSize)
-    averageMap_weighted = (mapS1toS1_weighted + mapS1toS2_weighted + mapS2toS1_weighted + mapS2toS2_weighted ) / 4 
 
+    numQueries = len(queryIndices)
+    totalSize = len(valLabels)
+    
+    mapS1toS1 = apS1toS1.mean().item() * 100
+    mapS1toS2 = apS1toS2.mean().item() * 100
+    mapS2toS1 = apS2toS1.mean().item() * 100
+    mapS2toS2 = apS2toS2.mean().item() * 100
+    averageMap, averageMap_ci = meanConfidenceInterval((apS1toS1 + apS1toS2 + apS2toS1 + apS2toS2) / 4, totalSize)
+    
+    mapS1toS1_weighted = apS1toS1_weighted.mean().item() * 100
+    mapS1toS2_weighted = apS1toS2_weighted.mean().item() * 100
+    mapS2toS1_weighted = apS2toS1_weighted.mean().item() * 100
+    mapS2toS2_weighted = apS2toS2_weighted.mean().item() * 100
+    averageMap_weighted, averageMap_weighted_ci = meanConfidenceInterval((apS1toS1_weighted + apS1toS2_weighted + apS2toS1_weighted + apS2toS2_weighted) / 4, totalSize)
+    
+    if numQueries < totalSize:
+        subsetLine = 'Subset of {} of {} queries, 95% confidence interval +/- {:.4f} (weighted +/- {:.4f})'.format(numQueries, totalSize, averageMap_ci, averageMap_weighted_ci)
+    else:
+        subsetLine = 'All {} queries'.format(totalSize)
+
+    print(subsetLine)
     print('# Roy mAP Calculations #')
     print('MaP for S1 to S1: ', mapS1toS1)
     print('MaP for S1 to S2: ', mapS1toS2)
@@ -717,10 +716,13 @@ def val(valloader, modelS1,modelS2, optimizerS1,optimizerS2, val_writer, gpuDisa
     print('MaP for S2 to S2: ', mapS2toS2_weighted)
     print('Average Weighted mAP@',args.k,':{0}'.format(averageMap_weighted))
     
-    
+    tag = 'subset_' if numQueries < totalSize else ''
+    val_writer.add_scalar(tag + 'mAP', averageMap, epoch)
+    val_writer.add_scalar(tag + 'weighted_mAP', averageMap_weighted, epoch)
     
     
     with open(resultsFile_name, 'a') as resultsFile:
+         resultsFile.write(subsetLine + '\n')
          resultsFile.write('# Roy mAP Calculations #\n')
          resultsFile.write("mAP S1-S1: {}\n ".format(mapS1toS1))
          resultsFile.write("mAP S1-S2: {}\n ".format(mapS1toS2))
@@ -734,11 +736,8 @@ def val(valloader, modelS1,modelS2, optimizerS1,optimizerS2, val_writer, gpuDisa
          resultsFile.write("mAP S2-S1: {}\n ".format(mapS2toS1_weighted))
          resultsFile.write("mAP S2-S2: {}\n ".format(mapS2toS2_weighted))
          resultsFile.write("Average mAP@{}: {}\n ".format(args.k, averageMap_weighted))
-         
-         
-         
 
-    return (averageMap,predicted_S1codes,predicted_S2codes,label_val,name_valS1,name_valS2)
+    return averageMap
     
     
 
@@ -0,0 +1,80 @@
+"""
+streaming per channel mean and standard deviation of the patches written to an LMDB file
+"""
+import json
+import numpy as np
+
+
+#LMDB key of the json metadata with the channel statistics
+META_KEY = b'__meta__'
+
+
+
+class BandStatistics(object):
+    """
+    Number of values, mean and sum of squared deviations (M2) of every channel of named (C, H, W) arrays.
+    Statistics of disjoint sets of patches are merged with the pairwise update of Chan et al.,
+    so the workers compute them per patch and the writer merges them in any order.
+    """
+    def __init__(self):
+        self.count = {}
+        self.mean = {}
+        self.M2 = {}
+
+    @classmethod
+    def ofArrays(cls, arrays):
+
+        stats = cls()
+        for name, array in arrays.items():
+            values = np.asarray(array, dtype=np.float64).reshape(array.shape[0], -1)
+            stats.count[name] = values.shape[1]
+            stats.mean[name] = values.mean(1)
+            stats.M2[name] = ((values - stats.mean[name][:, None]) ** 2).sum(1)
+        return stats
+
+    def merge(self, other):
+
+        for name in other.count:
+            if name not in self.count:
+                self.count[name] = other.count[name]
+                self.mean[name] = other.mean[name].copy()
+                self.M2[name] = other.M2[name].copy()
+                continue
+
+            countA, countB = self.count[name], other.count[name]
+            count = countA + countB
+            delta = other.mean[name] - self.mean[name]
+
+            self.mean[name] = self.mean[name] + delta * countB / count
+            self.M2[name] = self.M2[name] + other.M2[name] + delta ** 2 * countA * countB / count
+            self.count[name] = count
+        return self
+
+    def channelsMean(self):
+        return {name + '_mean': self.mean[name].tolist() for name in self.count}
+
+    def channelsStd(self):
+        return {name + '_std': np.sqrt(self.M2[name] / self.count[name]).tolist() for name in self.count}
+
+    def dumps(self, meta=None):
+        """
+        json metadata with the channel means and stds in the format of Normalize, the state to continue the statistics
+        and the additional entries of meta
+        """
+        meta = dict(meta or {})
+        meta.update({'channels_mean': self.channelsMean(), 'channels_std': self.channelsStd(),
+                     'count': self.count,
+                     'mean': {name: mean.tolist() for name, mean in self.mean.items()},
+                     'M2': {name: M2.tolist() for name, M2 in self.M2.items()}})
+        return json.dumps(meta).encode()
+
+    @classmethod
+    def loads(cls, buf):
+
+        meta = json.loads(bytes(buf).decode())
+        stats = cls()
+        for name in meta.get('count', {}):
+            stats.count[name] = meta['count'][name]
+            stats.mean[name] = np.array(meta['mean'][name])
+            stats.M2[name] = np.array(meta['M2'][name])
+        return stats
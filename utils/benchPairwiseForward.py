@@ -0,0 +1,105 @@
+#
+# Compares the forward passes of the MSE pairwise loss: two forward passes per model
+# over the halves of a batch against one forward pass per model over the whole batch.
+# Checks that both give the same logits with the BatchNorm running statistics (eval mode),
+# compares their MSE losses in train mode and measures training steps per second (forward and
+# backward of both models). In train mode BatchNorm normalizes with the statistics of the batch,
+# the split passes use the statistics of each half, so the train mode losses are only close.
+#
+# Usage: benchPairwiseForward.py [-b BATCH_SIZE] [--bits BITS] [--repeats N] [--tolerance T]
+
+import argparse
+import time
+import torch
+
+import sys
+sys.path.append('../')
+
+from utils.ResNet import ResNet50_S1, ResNet50_S2
+
+
+def splitForward(modelS1, modelS2, polars, bands):
+    half = polars.size(0) // 2
+    logitsS1 = torch.cat((modelS1(polars[:half]), modelS1(polars[half:])))
+    logitsS2 = torch.cat((modelS2(bands[:half]), modelS2(bands[half:])))
+    return logitsS1, logitsS2
+
+
+def fusedForward(modelS1, modelS2, polars, bands):
+    return modelS1(polars), modelS2(bands)
+
+
+def pairLoss(logitsS1, logitsS2, labels):
+    """
+    MSE loss of trainPairWiseCross.py over the pairs of the halves of the batch
+    """
+    half = logitsS1.size(0) // 2
+    lossFunc = torch.nn.MSELoss()
+    cos = torch.nn.CosineSimilarity(dim=1)
+    ones = torch.ones(half, device=labels.device)
+    cosBetweenLabels = cos(labels[:half], labels[half:])
+
+    return (lossFunc(cos(logitsS1[:half], logitsS1[half:]), cosBetweenLabels) +
+            lossFunc(cos(logitsS2[:half], logitsS2[half:]), cosBetweenLabels) +
+            lossFunc(cos(logitsS1[:half], logitsS2[:half]), ones) +
+            lossFunc(cos(logitsS1[half:], logitsS2[half:]), ones) +
+            lossFunc(cos(logitsS1[:half], logitsS2[half:]), cosBetweenLabels) +
+            lossFunc(cos(logitsS1[half:], logitsS2[:half]), cosBetweenLabels))
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parity and throughput of the fused pairwise forward pass')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', default=200, type=int, help='number of patches per batch')
+    parser.add_argument('--bits', default=16, type=int, help='number of bits of the hash codes')
+    parser.add_argument('--repeats', default=5, type=int, help='number of timed training steps')
+    parser.add_argument('--tolerance', default=0.05, type=float,
+                        help='relative difference of the train mode losses which is accepted')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    modelS1 = ResNet50_S1(args.bits).to(device)
+    modelS2 = ResNet50_S2(args.bits).to(device)
+    polars = torch.randn(args.batch_size, 2, 120, 120, device=device)
+    bands = torch.randn(args.batch_size, 12, 120, 120, device=device)
+    labels = torch.randint(0, 2, (args.batch_size, 19), device=device).float()
+
+    modelS1.eval()
+    modelS2.eval()
+    with torch.no_grad():
+        splitS1, splitS2 = splitForward(modelS1, modelS2, polars, bands)
+        fusedS1, fusedS2 = fusedForward(modelS1, modelS2, polars, bands)
+    print('eval mode logits: max abs difference S1 {:.3e}, S2 {:.3e}'.format(
+        (splitS1 - fusedS1).abs().max().item(), (splitS2 - fusedS2).abs().max().item()))
+
+    modelS1.train()
+    modelS2.train()
+    with torch.no_grad():
+        splitLoss = pairLoss(*splitForward(modelS1, modelS2, polars, bands), labels).item()
+        fusedLoss = pairLoss(*fusedForward(modelS1, modelS2, polars, bands), labels).item()
+    relativeDifference = abs(splitLoss - fusedLoss) / max(abs(splitLoss), 1e-12)
+    print('train mode MSE loss: split {:.6f}, fused {:.6f}, relative difference {:.3e} {} the tolerance {:.3e}'.format(
+        splitLoss, fusedLoss, relativeDifference, 'within' if relativeDifference <= args.tolerance else 'ABOVE', args.tolerance))
+    print('  (train mode BatchNorm uses the statistics of each half in the split passes and of the whole batch in the fused ones,'
+          ' the losses are not expected to be identical)')
+
+    for name, forward in (('split forward (4 passes)', splitForward), ('fused forward (2 passes)', fusedForward)):
+        logitsS1, logitsS2 = forward(modelS1, modelS2, polars, bands)
+        (logitsS1.mean() + logitsS2.mean()).backward()
+        synchronize(device)
+
+        start = time.time()
+        for _ in range(args.repeats):
+            modelS1.zero_grad()
+            modelS2.zero_grad()
+            logitsS1, logitsS2 = forward(modelS1, modelS2, polars, bands)
+            (logitsS1.mean() + logitsS2.mean()).backward()
+        synchronize(device)
+        elapsed = (time.time() - start) / args.repeats
+        print('{}: {:.2f} steps/s, {:.1f} patches/s'.format(name, 1 / elapsed, args.batch_size / elapsed))
@@ -0,0 +1,57 @@
+#
+# Compares the batched torch upsampling (upsampleBands) with the per patch skimage
+# upsampling (interp_band) of the Sentinel-2 20m and 60m bands: numerical parity and
+# throughput per batch. The parity check fails when the results differ by more than
+# float32 rounding (--rtol, --atol).
+#
+# Usage: benchUpsampling.py [-b BATCH_SIZE] [--repeats N] [--rtol RTOL] [--atol ATOL]
+
+import argparse
+import time
+import numpy as np
+import torch
+
+import sys
+sys.path.append('../')
+
+from utils.dataGenBigEarth import interp_band, upsampleBands
+
+
+def skimageBatch(bands20, bands60):
+    return (np.stack([interp_band(bands) for bands in bands20]),
+            np.stack([interp_band(bands) for bands in bands60]))
+
+
+def torchBatch(bands20, bands60):
+    return (upsampleBands(torch.from_numpy(bands20)),
+            upsampleBands(torch.from_numpy(bands60)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parity and throughput of the batched band upsampling')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', default=200, type=int, help='number of patches per batch')
+    parser.add_argument('--repeats', default=5, type=int, help='number of timed batches')
+    parser.add_argument('--rtol', default=1e-5, type=float, help='relative tolerance of the parity check')
+    parser.add_argument('--atol', default=0.1, type=float, help='absolute tolerance of the parity check (values up to 10000)')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    bands20 = rng.uniform(0, 10000, (args.batch_size, 6, 60, 60)).astype(np.float32)
+    bands60 = rng.uniform(0, 10000, (args.batch_size, 2, 20, 20)).astype(np.float32)
+
+    expected20, expected60 = skimageBatch(bands20, bands60)
+    result20, result60 = torchBatch(bands20, bands60)
+
+    for name, expected, result in (('bands20', expected20, result20), ('bands60', expected60, result60)):
+        difference = np.abs(expected - result.numpy())
+        print('{}: max abs difference {:.6f}, max rel difference {:.3e}'.format(
+            name, difference.max(), (difference / np.maximum(np.abs(expected), 1.0)).max()))
+        np.testing.assert_allclose(result.numpy(), expected, rtol=args.rtol, atol=args.atol,
+                                   err_msg='{} of upsampleBands differs from interp_band'.format(name))
+
+    for name, upsample in (('skimage interp_band', skimageBatch), ('torch upsampleBands', torchBatch)):
+        start = time.time()
+        for _ in range(args.repeats):
+            upsample(bands20, bands60)
+        elapsed = (time.time() - start) / args.repeats
+        print('{}: {:.4f} s per batch, {:.1f} patches/s'.format(name, elapsed, args.batch_size / elapsed))
@@ -0,0 +1,74 @@
+"""
+checkpoint snapshots which are written to disk by a background thread while training continues
+"""
+import os
+import queue
+import threading
+import torch
+
+
+
+def cpuClone(state):
+    """
+    copy of a (nested) state dict with every tensor cloned to the CPU, later optimizer steps do not change it
+    """
+    if torch.is_tensor(state):
+        return state.detach().cpu().clone()
+    if isinstance(state, dict):
+        return {key: cpuClone(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpuClone(value) for value in state)
+    return state
+
+
+def saveAtomically(state, fileName):
+    """
+    torch.save into a temporary file which replaces fileName, an interrupted save keeps the previous file intact
+    """
+    tmpFileName = fileName + '.tmp'
+    torch.save(state, tmpFileName)
+    os.replace(tmpFileName, fileName)
+    return fileName
+
+
+
+class BackgroundSaver(object):
+    """
+    Runs save tasks in submission order on a single background thread.
+    At most maxPending tasks wait, submit blocks when the disk falls behind instead of piling up state copies.
+    """
+    def __init__(self, maxPending=2):
+        self.tasks = queue.Queue(maxPending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            try:
+                task()
+            except Exception as e:
+                self.error = e
+
+    def _raiseError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, function, *args):
+        """
+        run function(*args) in the background, the arguments must not be modified afterwards (see cpuClone)
+        """
+        self._raiseError()
+        self.tasks.put(lambda: function(*args))
+
+    def close(self):
+        """
+        wait until every submitted task is written
+        """
+        self.tasks.put(None)
+        self.thread.join()
+        self._raiseError()
@@ -0,0 +1,180 @@
+"""
+single file archive of packed hash codes, packed labels and patch names which is opened with mmap
+
+layout:
+    magic (8 bytes) | version (uint32) | header length (uint32) | JSON header | sections aligned to 64 bytes
+the JSON header records the bit length, the model epoch, the checkpoint hash and the offset, dtype
+and shape of every section, so that each section is a zero copy view of the memory map
+"""
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+import torch
+
+from utils.hammingSearch import packCodes, packLabels
+
+
+ARCHIVE_MAGIC = b'CBIRCODE'
+ARCHIVE_VERSION = 1
+ARCHIVE_FILE_NAME = 'codeArchive.bin'
+SECTION_ALIGNMENT = 64
+
+PREAMBLE = struct.Struct('<8sII')
+
+
+
+def fileHash(fileName, chunkSize=1 << 20):
+    """
+    sha256 of a file, e.g. the checkpoint the codes have been generated with
+    """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def alignOffset(offset):
+    return (offset + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+
+def encodeNames(names):
+    """
+    string table of patch names: int64 offsets of shape (N+1,) and the utf-8 blob
+    """
+    encoded = [str(name).encode('utf-8') for name in names]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(name) for name in encoded])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def toNumpy(array):
+    if torch.is_tensor(array):
+        return array.detach().cpu().numpy()
+    return np.asarray(array)
+
+
+def writeCodeArchive(fileName, S1Codes, S2Codes, labels, S1Names, S2Names, bits, epoch=None, checkpointHash=None):
+    """
+    write binary codes (N, bits), multi-hot labels (N, classes) and patch names into one archive file
+    """
+    writePackedCodeArchive(fileName, toNumpy(packCodes(S1Codes)), toNumpy(packCodes(S2Codes)),
+                           toNumpy(packLabels(labels)), labels.shape[1], S1Names, S2Names, bits,
+                           epoch=epoch, checkpointHash=checkpointHash)
+
+
+def writePackedCodeArchive(fileName, packedS1Codes, packedS2Codes, packedLabels, numClasses, S1Names, S2Names, bits, epoch=None, checkpointHash=None):
+    """
+    write codes and labels which are already packed by packCodes and packLabels into one archive file
+    """
+    S1NameOffsets, S1NameBlob = encodeNames(S1Names)
+    S2NameOffsets, S2NameBlob = encodeNames(S2Names)
+
+    sections = [
+        ('S1Codes', packedS1Codes),
+        ('S2Codes', packedS2Codes),
+        ('labels', packedLabels),
+        ('S1NameOffsets', S1NameOffsets),
+        ('S1Names', S1NameBlob),
+        ('S2NameOffsets', S2NameOffsets),
+        ('S2Names', S2NameBlob),
+    ]
+
+    header = {
+        'bits': int(bits),
+        'numItems': int(len(S1NameOffsets) - 1),
+        'numClasses': int(numClasses),
+        'epoch': epoch,
+        'checkpointHash': checkpointHash,
+        'sections': {},
+    }
+
+    #offsets depend on the header length, which depends on the offsets, so reserve space generously
+    headerReserve = 4096
+    offset = alignOffset(PREAMBLE.size + headerReserve)
+    for name, array in sections:
+        header['sections'][name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset = alignOffset(offset + array.nbytes)
+
+    headerBytes = json.dumps(header).encode('utf-8')
+    if len(headerBytes) > headerReserve:
+        raise ValueError('archive header is too large: {} bytes'.format(len(headerBytes)))
+
+    temporaryFileName = fileName + '.tmp'
+    with open(temporaryFileName, 'wb') as f:
+        f.write(PREAMBLE.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(headerBytes)))
+        f.write(headerBytes)
+        for name, array in sections:
+            f.seek(header['sections'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(offset)
+    os.replace(temporaryFileName, fileName)
+
+
+
+class NameTable(object):
+    """Lazily decoded patch names of a string table section"""
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        return self.blob[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+
+
+class CodeArchive(object):
+    """
+    Read only view of an archive file. The file is memory mapped copy-on-write, sections are not copied
+    and processes opening the same archive share its pages.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+        with open(fileName, 'rb') as f:
+            magic, version, headerLength = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != ARCHIVE_MAGIC:
+                raise ValueError('{} is not a code archive'.format(fileName))
+            if version != ARCHIVE_VERSION:
+                raise ValueError('unsupported code archive version {} of {}'.format(version, fileName))
+            self.header = json.loads(f.read(headerLength).decode('utf-8'))
+
+        self.data = np.memmap(fileName, dtype=np.uint8, mode='c')
+
+        self.bits = self.header['bits']
+        self.numClasses = self.header['numClasses']
+        self.epoch = self.header['epoch']
+        self.checkpointHash = self.header['checkpointHash']
+
+        self.S1Names = NameTable(self.section('S1NameOffsets'), self.section('S1Names'))
+        self.S2Names = NameTable(self.section('S2NameOffsets'), self.section('S2Names'))
+
+    def __len__(self):
+        return self.header['numItems']
+
+    def section(self, name):
+        description = self.header['sections'][name]
+        dtype = np.dtype(description['dtype'])
+        count = int(np.prod(description['shape']))
+        start = description['offset']
+
+        array = self.data[start:start + count * dtype.itemsize].view(dtype)
+        return array.reshape(description['shape'])
+
+    @property
+    def S1Codes(self):
+        return torch.from_numpy(self.section('S1Codes'))
+
+    @property
+    def S2Codes(self):
+        return torch.from_numpy(self.section('S2Codes'))
+
+    @property
+    def labels(self):
+        return torch.from_numpy(self.section('labels'))
@@ -0,0 +1,61 @@
+#
+# Converts an LMDB file written with pyarrow serialization into the binary record layout
+# of utils/lmdbRecord.py
+#
+# Usage: convertLMDB.py -i INPUT_LMDB -o OUTPUT_LMDB
+
+import argparse
+import lmdb
+import numpy as np
+
+import sys
+sys.path.append('../')
+
+from utils.lmdbRecord import dumpsRecord, loadsValue, isRecord
+
+
+def convertValue(key, buf):
+    if isRecord(buf):
+        return bytes(buf)
+
+    value = loadsValue(buf)
+    if key == b'__keys__':
+        return dumpsRecord((np.array(value),))
+    if key == b'__len__':
+        return dumpsRecord((np.array(value, dtype=np.int64),))
+    return dumpsRecord(value)
+
+
+def convert_lmdb(input_path, output_path, commit_interval=10000):
+
+    src = lmdb.open(input_path, readonly=True, lock=False, readahead=False, meminit=False)
+    dst = lmdb.open(output_path, map_size=src.info()['map_size'])
+
+    nSamples = src.stat()['entries']
+    txn = dst.begin(write=True)
+    with src.begin(write=False, buffers=True) as src_txn:
+        for idx, (key, buf) in enumerate(src_txn.cursor()):
+            key = bytes(key)
+            txn.put(key, convertValue(key, buf))
+
+            if (idx + 1) % commit_interval == 0:
+                print("[%d/%d]" % (idx + 1, nSamples))
+                txn.commit()
+                txn = dst.begin(write=True)
+    txn.commit()
+
+    print("Flushing database ...")
+    dst.sync()
+    dst.close()
+    src.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=
+        'This script converts LMDB files of pyarrow serialized patches into the binary record layout')
+    parser.add_argument('-i', '--input', dest='input', help='path of the existing LMDB file')
+    parser.add_argument('-o', '--output', dest='output', help='path of the converted LMDB file')
+
+    args = parser.parse_args()
+
+    convert_lmdb(args.input, args.output)
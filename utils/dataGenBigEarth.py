@@ -1,10 +1,107 @@
 import csv
+import json
+import os
+from functools import lru_cache
 import numpy as np
 import lmdb
-import pyarrow as pa
 import torch
+from torch.utils.data.dataloader import default_convert
 from skimage.transform import resize
 
+from utils.lmdbRecord import loadsValue
+from utils.bandStatistics import META_KEY
+
+
+#channel statistics of LMDB files written without them
+SERBIA_CHANNELS_MEAN = {
+    'bands10_mean': [ 458.93423 ,  676.8278,  665.719, 2590.4482],
+    'bands20_mean': [ 1065.233, 2068.3826, 2435.3057, 2647.92, 2010.1838, 1318.5911],
+    'bands60_mean': [ 341.05457, 2630.7898 ],
+    'polarVH_mean': [ -15.827944 ],
+    'polarVV_mean': [ -9.317011]
+}
+
+SERBIA_CHANNELS_STD = {
+    'bands10_std': [ 315.86624,  305.07462,  302.11145, 310.93375],
+    'bands20_std': [ 288.43314, 287.29364, 299.83383, 295.51282, 211.81876,  193.92213],
+    'bands60_std': [ 267.79263, 292.94092 ],
+    'polarVH_std': [ 0.782826 ],
+    'polarVV_std': [ 1.8147297]
+}
+
+BIGEARTHNET_CHANNELS_MEAN = {
+    'bands10_mean': [ 429.9430203 ,  614.21682446,  590.23569706, 2218.94553375],
+    'bands20_mean': [ 950.68368468, 1792.46290469, 2075.46795189, 2266.46036911, 1594.42694882, 1009.32729131],
+    'bands60_mean': [ 340.76769064, 2246.0605464 ]
+}
+
+BIGEARTHNET_CHANNELS_STD = {
+    'bands10_std': [ 572.41639287,  582.87945694,  675.88746967, 1365.45589904],
+    'bands20_std': [ 729.89827633, 1096.01480586, 1273.45393088, 1356.13789355, 1079.19066363,  818.86747235],
+    'bands60_std': [ 554.81258967, 1302.3292881 ]
+}
+
+
+#LMDB files of prep_splits.py --per_split, named after the split for Sentinel-1, Sentinel-2 and paired files alike
+SPLIT_NAMES = ('train', 'val', 'test')
+
+
+def splitLMDBPath(bigEarthPthLMDB, state, csv_file=None):
+    """
+    LMDB file of the split state when the splits have been written to their own files (prep_splits.py --per_split),
+    files of older builds are named as the csv file of the split
+    """
+    names = [state]
+    if csv_file is not None:
+        names.append(os.path.basename(csv_file).split('.')[0])
+    
+    for name in names:
+        if name is not None and os.path.isdir(os.path.join(bigEarthPthLMDB, name)):
+            return os.path.join(bigEarthPthLMDB, name)
+    
+    if not os.path.isfile(os.path.join(bigEarthPthLMDB, 'data.mdb')) and len(splitsOfLMDB(bigEarthPthLMDB)) > 0:
+        raise ValueError('{} has the LMDB files of the splits {}, but none of the split {}'.format(
+                         bigEarthPthLMDB, ', '.join(splitsOfLMDB(bigEarthPthLMDB)), state))
+    
+    return bigEarthPthLMDB
+
+
+def splitsOfLMDB(bigEarthPthLMDB):
+    """
+    names of the splits which have been written to their own LMDB files in the folder
+    """
+    return [name for name in SPLIT_NAMES if os.path.isdir(os.path.join(bigEarthPthLMDB, name))]
+
+
+def loadChannelStatistics(lmdbPaths, train_csv=None, isSerbia=False):
+    """
+    channel means and stds of the train split which prep_splits has stored in the LMDB files (in the train file with --per_split),
+    the literals of Serbia or BigEarthNet are used for LMDB files written without them
+    :return: channels_mean, channels_std in the format of Normalize for Sentinel-1 and Sentinel-2
+    """
+    channels_mean = dict(SERBIA_CHANNELS_MEAN if isSerbia else BIGEARTHNET_CHANNELS_MEAN)
+    channels_std = dict(SERBIA_CHANNELS_STD if isSerbia else BIGEARTHNET_CHANNELS_STD)
+    
+    for lmdbPath in lmdbPaths:
+        if lmdbPath is None:
+            continue
+        
+        env = lmdb.open(splitLMDBPath(lmdbPath, 'train', train_csv), readonly=True, lock=False, readahead=False, meminit=False)
+        with env.begin(write=False) as txn:
+            meta = txn.get(META_KEY)
+        env.close()
+        
+        if meta is not None:
+            meta = json.loads(bytes(meta).decode())
+            channels_mean.update(meta['channels_mean'])
+            channels_std.update(meta['channels_std'])
+    
+    for name in ('polarVH', 'polarVV', 'bands10', 'bands20', 'bands60'):
+        if name + '_mean' not in channels_mean:
+            raise ValueError('no channel statistics of {}, the LMDB files have to be prepared again to compute them'.format(name))
+    
+    return channels_mean, channels_std
+
 def interp_band(bands, img10_shape=[120,120]):
     """ 
     https://github.com/lanha/DSen2/blob/master/utils/patches.py
@@ -17,13 +114,50 @@ def interp_band(bands, img10_shape=[120,120]):
     return bands_interp
 
 
-def loads_pyarrow(buf):
+@lru_cache(maxsize=None)
+def interpolationMatrix(in_size, out_size):
     """
-    Args:
-        buf: the output of `dumps`.
+    (out_size, in_size) weights of the bilinear interpolation done by skimage resize with mode='reflect',
+    pixel centers are aligned and samples outside the image are mirrored at the border pixels
     """
-    return pa.deserialize(buf)
+    coords = (np.arange(out_size) + 0.5) * in_size / out_size - 0.5
+    lower = np.floor(coords).astype(np.int64)
+    fraction = coords - lower
+
+    matrix = np.zeros((out_size, in_size))
+    for idx, weight in ((lower, 1 - fraction), (lower + 1, fraction)):
+        idx = np.abs(idx)
+        idx = np.where(idx > in_size - 1, 2 * (in_size - 1) - idx, idx)
+        np.add.at(matrix, (np.arange(out_size), idx), weight)
+
+    return torch.from_numpy(matrix)
+
 
+def upsampleBands(bands, img10_shape=(120,120)):
+    """
+    interp_band for a whole batch of shape (B, C, H, W) at once, as two matrix products
+    """
+    rows = interpolationMatrix(bands.size(-2), img10_shape[0]).to(bands)
+    cols = interpolationMatrix(bands.size(-1), img10_shape[1]).to(bands)
+    
+    return torch.matmul(torch.matmul(rows, bands), cols.t())
+
+
+def upsampleBatch(batch):
+    """
+    upsampling of bands20 and bands60 of an already collated batch, e.g. of dataGenBigEarthLMDB.getBatch,
+    arrays which are left as numpy arrays by the transforms (the labels) are converted to tensors by default_convert
+    """
+    batch = default_convert(batch)
+    
+    for data in (batch if isinstance(batch, (tuple, list)) else [batch]):
+        if 'bands10' in data:
+            size = tuple(data['bands10'].shape[-2:])
+            for key in ('bands20', 'bands60'):
+                if tuple(data[key].shape[-2:]) != size:
+                    data[key] = upsampleBands(data[key], size)
+    
+    return batch
 
 
 class dataGenBigEarthLMDB:
@@ -31,12 +165,13 @@ class dataGenBigEarthLMDB:
     def __init__(self, bigEarthPthLMDB=None, imgTransform=None, state='train', upsampling=False, 
                 train_csv=None, val_csv=None, test_csv=None, isSentinel2 = False):
 
-        self.env = lmdb.open(bigEarthPthLMDB, readonly=True, lock=False, readahead=False, meminit=False)
         self.imgTransform = imgTransform
         self.train_bigEarth_csv = train_csv
         self.val_bigEarth_csv = val_csv
         self.test_bigEarth_csv = test_csv
         self.state = state
+        self.env = lmdb.open(splitLMDBPath(bigEarthPthLMDB, self.state, self.csvOfState()), readonly=True, lock=False, readahead=False, meminit=False)
+        self.numClasses = self.metaOfLMDB().get('numClasses')
         self.upsampling = upsampling
         self.patch_names = []
         self.readingCSV()
@@ -44,28 +179,33 @@ class dataGenBigEarthLMDB:
 
 
     def readingCSV(self):
-        if self.state == 'train':
-            with open(self.train_bigEarth_csv, 'r') as f:
-                csv_reader = csv.reader(f)
-                for row in csv_reader:
-                    self.patch_names.append(row[0])
+        csv_file = self.csvOfState()
+        if csv_file is None:
+            #the dataset is only used for lookups by patch name
+            return
+        
+        with open(csv_file, 'r') as f:
+            csv_reader = csv.reader(f)
+            for row in csv_reader:
+                self.patch_names.append(row[0])
 
+    def csvOfState(self):
+        if self.state == 'train':
+            return self.train_bigEarth_csv
         elif self.state == 'val':
-            with open(self.val_bigEarth_csv, 'r') as f:
-                csv_reader = csv.reader(f)
-                for row in csv_reader:
-                    self.patch_names.append(row[0])
+            return self.val_bigEarth_csv
         else:
-            with open(self.test_bigEarth_csv, 'r') as f:
-                csv_reader = csv.reader(f)
-                for row in csv_reader:
-                    self.patch_names.append(row[0])
+            return self.test_bigEarth_csv
 
     def __len__(self):
 
         return len(self.patch_names)
 
     def __getitem__(self, idx):
+        
+        if isinstance(idx, (list, tuple)):
+            #all indices of a minibatch given by a BatchSampler
+            return self.getBatch(idx)
        
         patch_name = self.patch_names[idx]
         if self.isSentinel2:
@@ -77,18 +217,98 @@ class dataGenBigEarthLMDB:
         else:
             return self._getDataUp(patch_name, idx)
 
+    def getByName(self, patch_name):
+        """
+        sample of a Sentinel-1 patch name, which does not need to be in the csv file of the split
+        """
+        if self.isSentinel2:
+            patch_name = self.s1NameToS2(patch_name)
+        
+        if not self.upsampling:
+            return self._getData(patch_name, None)
+        else:
+            return self._getDataUp(patch_name, None)
+
+    def hasName(self, patch_name):
+        """
+        whether the LMDB file has the Sentinel-1 patch name
+        """
+        if self.isSentinel2:
+            patch_name = self.s1NameToS2(patch_name)
+        
+        with self.env.begin(write=False, buffers=True) as txn:
+            return txn.get(patch_name.encode()) is not None
+
+    def getBatch(self, indices):
+        """
+        collated sample of a minibatch, the values are read in key order in one transaction
+        and copied straight into preallocated batch arrays
+        """
+        patch_names = [self.patch_names[idx] for idx in indices]
+        if self.isSentinel2:
+            patch_names = [self.s1NameToS2(patch_name) for patch_name in patch_names]
+        
+        sample = self._readBatch(patch_names)
+        sample['patchName'] = patch_names
+        
+        if self.imgTransform is not None:
+            sample = self.imgTransform(sample)
+        
+        return sample
+
+    def _readBatch(self, patch_names):
+        
+        batch = None
+        with self.env.begin(write=False, buffers=True) as txn:
+            for position in sorted(range(len(patch_names)), key=patch_names.__getitem__):
+                arrays = self._recordArrays(loadsValue(txn.get(patch_names[position].encode())))
+                
+                if batch is None:
+                    batch = {key: np.empty((len(patch_names),) + array.shape, dtype=np.float32) for key, array in arrays.items()}
+                for key, array in arrays.items():
+                    batch[key][position] = array
+        
+        return batch
+
+    def _recordArrays(self, record):
+        """
+        arrays of a value by sample key, views of the memory map unless they are interpolated
+        """
+        if not self.isSentinel2:
+            polarVH, polarVV, multiHots = record
+            return {'polarVH': polarVH, 'polarVV': polarVV, 'label': self.labelOf(multiHots)}
+        
+        arrays = self._bandArrays(record, self.upsampling)
+        arrays['label'] = self.labelOf(arrays['label'])
+        return arrays
+
+    def _bandArrays(self, record, upsampling):
+        
+        if len(record) == 2:
+            bands, multiHots = record
+            return {'bands10': bands[:4], 'bands20': bands[4:10], 'bands60': bands[10:], 'label': multiHots}
+        
+        bands10, bands20, bands60, multiHots = record
+        
+        if upsampling:
+            bands20 = interp_band(bands20)
+            bands60 = interp_band(bands60)
+        
+        return {'bands10': bands10, 'bands20': bands20, 'bands60': bands60, 'label': multiHots}
+
     def _getData(self, patch_name, idx):
         
-        with self.env.begin(write=False) as txn:
+        #values are views of the memory map, they are copied by astype before the transaction ends
+        with self.env.begin(write=False, buffers=True) as txn:
             byteflow = txn.get(patch_name.encode())
 
-        if not self.isSentinel2:
-            polarVH, polarVV, multiHots = loads_pyarrow(byteflow)
-            sample = {'patchName': patch_name , 'polarVH':polarVH.astype(np.float32), 'polarVV':polarVV.astype(np.float32) , 'label': multiHots.astype(np.float32)}
+            if not self.isSentinel2:
+                polarVH, polarVV, multiHots = loadsValue(byteflow)
+                sample = {'patchName': patch_name , 'polarVH':polarVH.astype(np.float32), 'polarVV':polarVV.astype(np.float32) , 'label': self.labelOf(multiHots)}
 
-        else:  
-            bands10, bands20, bands60, multiHots = loads_pyarrow(byteflow)
-            sample = {'patchName': patch_name , 'bands10':bands10.astype(np.float32), 'bands20':bands20.astype(np.float32), 'bands60':bands60.astype(np.float32), 'label': multiHots.astype(np.float32)}
+            else:  
+                bands10, bands20, bands60, multiHots = self._decodeBands(loadsValue(byteflow), False)
+                sample = {'patchName': patch_name , 'bands10':bands10, 'bands20':bands20, 'bands60':bands60, 'label': self.labelOf(multiHots)}
 
 
         if self.imgTransform is not None:
@@ -100,26 +320,125 @@ class dataGenBigEarthLMDB:
         
 
         
-        with self.env.begin(write=False) as txn:
+        with self.env.begin(write=False, buffers=True) as txn:
             byteflow = txn.get(patch_name.encode())
 
-        bands10, bands20, bands60, multiHots = loads_pyarrow(byteflow)
-
-        bands20 = interp_band(bands20)
-        bands60 = interp_band(bands60)
+            bands10, bands20, bands60, multiHots = self._decodeBands(loadsValue(byteflow), True)
 
-        sample = {'patchName':patch_name ,'bands10':bands10.astype(np.float32), 'bands20':bands20.astype(np.float32), 'bands60':bands60.astype(np.float32), 'label': multiHots.astype(np.float32)}
+            sample = {'patchName':patch_name ,'bands10':bands10, 'bands20':bands20, 'bands60':bands60, 'label': self.labelOf(multiHots)}
 
         if self.imgTransform is not None:
             sample = self.imgTransform(sample)
         
         return sample
 
+    def _decodeBands(self, record, upsampling):
+        """
+        float32 copies of bands10, bands20, bands60 and the multi hot labels of the arrays of a Sentinel-2 value
+        """
+        if len(record) == 2:
+            #stored upsampled to 120x120 as one array ordered as bands10, bands20, bands60
+            bands, multiHots = record
+            bands = bands.astype(np.float32)
+            return bands[:4], bands[4:10], bands[10:], multiHots
+        
+        bands10, bands20, bands60, multiHots = record
+        
+        if upsampling:
+            bands20 = interp_band(bands20)
+            bands60 = interp_band(bands60)
+        
+        return bands10.astype(np.float32), bands20.astype(np.float32), bands60.astype(np.float32), multiHots
+
+    def metaOfLMDB(self):
+        """
+        json metadata written by prep_splits, empty for LMDB files written without it
+        """
+        with self.env.begin(write=False) as txn:
+            meta = txn.get(META_KEY)
+        
+        return json.loads(bytes(meta).decode()) if meta is not None else {}
+
+    def labelOf(self, multiHots):
+        """
+        float32 multi hot labels of the stored labels, packed bitsets are unpacked to numClasses labels
+        """
+        if multiHots.dtype == np.uint8:
+            if self.numClasses is None:
+                raise ValueError('the LMDB file has packed labels but no numClasses in its metadata, '
+                                 'it has to be prepared again')
+            return np.unpackbits(multiHots, count=self.numClasses).astype(np.float32)
+        
+        return multiHots.astype(np.float32)
+
     def s1NameToS2(self,s1Name):        
         s2Name = s1Name.replace('S1_','')
         return s2Name
 
 
+class dataGenBigEarthPairedLMDB(dataGenBigEarthLMDB):
+    """
+    Sentinel-1 and Sentinel-2 samples of a patch read from a paired LMDB file (Sentinel-1/prep_splits.py --paired),
+    both modalities are decoded from one value in one transaction. Items are (sampleS1, sampleS2) as with ConcatDataset.
+    """
+    def __init__(self, pairedPthLMDB=None, imgTransformS1=None, imgTransformS2=None, state='train', upsampling=False, 
+                train_csv=None, val_csv=None, test_csv=None):
+        
+        super(dataGenBigEarthPairedLMDB, self).__init__(pairedPthLMDB, None, state, upsampling, train_csv, val_csv, test_csv)
+        self.imgTransformS1 = imgTransformS1
+        self.imgTransformS2 = imgTransformS2
+
+    def __getitem__(self, idx):
+        
+        if isinstance(idx, (list, tuple)):
+            return self.getBatch(idx)
+        
+        return self.getByName(self.patch_names[idx])
+
+    def getBatch(self, indices):
+        
+        patch_names = [self.patch_names[idx] for idx in indices]
+        batch = self._readBatch(patch_names)
+        
+        sampleS1 = {'patchName': patch_names, 'polarVH': batch['polarVH'], 'polarVV': batch['polarVV'], 'label': batch['label']}
+        sampleS2 = {'patchName': [self.s1NameToS2(patch_name) for patch_name in patch_names], 
+                    'bands10': batch['bands10'], 'bands20': batch['bands20'], 'bands60': batch['bands60'], 'label': batch['label'].copy()}
+        
+        if self.imgTransformS1 is not None:
+            sampleS1 = self.imgTransformS1(sampleS1)
+        if self.imgTransformS2 is not None:
+            sampleS2 = self.imgTransformS2(sampleS2)
+        
+        return sampleS1, sampleS2
+
+    def _recordArrays(self, record):
+        
+        arrays = self._bandArrays(record[2:], self.upsampling)
+        arrays['label'] = self.labelOf(arrays['label'])
+        arrays['polarVH'] = record[0]
+        arrays['polarVV'] = record[1]
+        return arrays
+
+    def getByName(self, patch_name):
+        
+        with self.env.begin(write=False, buffers=True) as txn:
+            record = loadsValue(txn.get(patch_name.encode()))
+            
+            polarVH, polarVV = record[0], record[1]
+            bands10, bands20, bands60, multiHots = self._decodeBands(record[2:], self.upsampling)
+            label = self.labelOf(multiHots)
+
+            sampleS1 = {'patchName': patch_name, 'polarVH':polarVH.astype(np.float32), 'polarVV':polarVV.astype(np.float32), 'label': label}
+            sampleS2 = {'patchName': self.s1NameToS2(patch_name), 'bands10':bands10, 'bands20':bands20, 'bands60':bands60, 'label': label.copy()}
+
+        if self.imgTransformS1 is not None:
+            sampleS1 = self.imgTransformS1(sampleS1)
+        if self.imgTransformS2 is not None:
+            sampleS2 = self.imgTransformS2(sampleS2)
+        
+        return sampleS1, sampleS2
+
+
 class ConcatDataset(object):
     def __init__(self, *datasets):
         self.datasets = datasets
@@ -132,6 +451,13 @@ class ConcatDataset(object):
 
 
 
+def channelsOf(tensor):
+    """
+    channel views of a (C, H, W) sample or of a (B, C, H, W) batch
+    """
+    return tensor if tensor.dim() == 3 else tensor.transpose(0, 1)
+
+
 class Normalize(object):
     def __init__(self, channels_mean, channels_std,isSentinel2):
         
@@ -158,10 +484,10 @@ class Normalize(object):
         if not self.isSentinel2:
             polarVH, polarVV, label, patchName = sample['polarVH'], sample['polarVV'], sample['label'], sample['patchName']
          
-            for t, m, s in zip(polarVH, self.polarVH_mean, self.polarVH_std):
+            for t, m, s in zip(channelsOf(polarVH), self.polarVH_mean, self.polarVH_std):
                 t.sub_(m).div_(s)
             
-            for t, m, s in zip(polarVV, self.polarVV_mean, self.polarVV_std):
+            for t, m, s in zip(channelsOf(polarVV), self.polarVV_mean, self.polarVV_std):
                 t.sub_(m).div_(s)
             
             return {'polarVH':polarVH, 'polarVV':polarVV, 'label':label, 'patchName': patchName }
@@ -171,13 +497,13 @@ class Normalize(object):
         else:
             band10, band20, band60, label, patchName = sample['bands10'], sample['bands20'], sample['bands60'], sample['label'], sample['patchName']
             
-            for t, m, s in zip(band10, self.bands10_mean, self.bands10_std):
+            for t, m, s in zip(channelsOf(band10), self.bands10_mean, self.bands10_std):
                 t.sub_(m).div_(s)
             
-            for t, m, s in zip(band20, self.bands20_mean, self.bands20_std):
+            for t, m, s in zip(channelsOf(band20), self.bands20_mean, self.bands20_std):
                 t.sub_(m).div_(s)
             
-            for t, m, s in zip(band60, self.bands60_mean, self.bands60_std):
+            for t, m, s in zip(channelsOf(band60), self.bands60_mean, self.bands60_std):
                 t.sub_(m).div_(s)
         
             return {'bands10':band10, 'bands20':band20, 'bands60':band60, 'label':label, 'patchName': patchName }
@@ -205,5 +531,87 @@ class ToTensor(object):
 
 
 
+class ToNormalizedTensor(object):
+    """
+    ToTensor and Normalize in one transform, the arrays of a sample or of a batch are wrapped by torch.from_numpy
+    without a copy and normalized with the means and stds of all their channels broadcast at once.
+    The result is a new tensor, the arrays of the sample (e.g. a batch of the data loader) are left unchanged
+    """
+    def __init__(self, channels_mean, channels_std, isSentinel2):
+        
+        self.isSentinel2 = isSentinel2
+        
+        if not self.isSentinel2:
+            self.keys = ['polarVH', 'polarVV']
+        else:
+            self.keys = ['bands10', 'bands20', 'bands60']
+        
+        #float32 as the arrays, the scalars of Normalize are cast to float32 by torch as well
+        self.means = {key: torch.tensor(channels_mean[key + '_mean'], dtype=torch.float32).view(-1, 1, 1) for key in self.keys}
+        self.stds = {key: torch.tensor(channels_std[key + '_std'], dtype=torch.float32).view(-1, 1, 1) for key in self.keys}
+        
+        self.mean = torch.cat([self.means[key] for key in self.keys])
+        self.std = torch.cat([self.stds[key] for key in self.keys])
+
+    def __call__(self, sample):
+        
+        sample = dict(sample)
+        for key in self.keys:
+            tensor = sample[key]
+            if isinstance(tensor, np.ndarray):
+                tensor = torch.from_numpy(tensor)
+            
+            sample[key] = (tensor - self.means[key].to(tensor.device)) / self.stds[key].to(tensor.device)
+        
+        return sample
+
+    def to(self, device):
+        
+        self.means = {key: mean.to(device) for key, mean in self.means.items()}
+        self.stds = {key: std.to(device) for key, std in self.stds.items()}
+        self.mean = self.mean.to(device)
+        self.std = self.std.to(device)
+        return self
+
+    def stacked(self, array):
+        """
+        normalized tensor of the channels of all arrays concatenated in key order,
+        e.g. the 2 channel Sentinel-1 or 12 channel Sentinel-2 input of the models, in one op
+        """
+        tensor = torch.from_numpy(array) if isinstance(array, np.ndarray) else array
+        
+        return (tensor - self.mean.to(tensor.device)) / self.std.to(tensor.device)
+
+
 
+class DevicePreprocessing(object):
+    """
+    preprocessing of raw (not normalized) Sentinel-1 and Sentinel-2 batches on the device of the models:
+    every array is transferred once with non_blocking=True from pinned memory, then normalized, upsampled
+    if needed and concatenated into the 2 and 12 channel model inputs on the device
+    :param memoryFormat: memory format of the model inputs, torch.channels_last for models converted to it
+    """
+    def __init__(self, channels_mean, channels_std, device, memoryFormat=torch.contiguous_format):
+        
+        self.device = device
+        self.memoryFormat = memoryFormat
+        self.normalizeS1 = ToNormalizedTensor(channels_mean, channels_std, False).to(device)
+        self.normalizeS2 = ToNormalizedTensor(channels_mean, channels_std, True).to(device)
 
+    def toDevice(self, sample, keys):
+        
+        return {key: torch.as_tensor(sample[key]).to(self.device, non_blocking=True) for key in keys}
+
+    def __call__(self, dataS1, dataS2):
+        """
+        :return: polars (B, 2, 120, 120), bands (B, 12, 120, 120) and labels on the device
+        """
+        sampleS1 = self.normalizeS1(self.toDevice(dataS1, self.normalizeS1.keys))
+        polars = torch.cat((sampleS1['polarVH'], sampleS1['polarVV']), dim=1)
+        
+        sampleS2 = upsampleBatch(self.normalizeS2(self.toDevice(dataS2, self.normalizeS2.keys)))
+        bands = torch.cat((sampleS2['bands10'], sampleS2['bands20'], sampleS2['bands60']), dim=1)
+        
+        labels = torch.as_tensor(dataS2['label']).to(self.device, non_blocking=True)
+        
+        return polars.contiguous(memory_format=self.memoryFormat), bands.contiguous(memory_format=self.memoryFormat), labels
@@ -0,0 +1,322 @@
+"""
+packed hash code search engine for Hamming space retrieval
+"""
+import hashlib
+import itertools
+import math
+import os
+import numpy as np
+import torch
+
+
+#number of set bits of every byte value
+POPCOUNT_TABLE = torch.tensor([bin(i).count('1') for i in range(256)], dtype=torch.uint8)
+
+#bit weights of a byte, most significant bit first as in numpy.packbits
+BIT_WEIGHTS = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+
+
+
+def packCodes(codes):
+    """
+    pack binary codes of shape (N, bits) with 0/1 values into uint8 words of shape (N, ceil(bits/8))
+    """
+    numBits = codes.size(1)
+    numBytes = (numBits + 7) // 8
+
+    binary = codes.ge(0.5).to(torch.uint8)
+    if numBytes * 8 != numBits:
+        padding = binary.new_zeros(binary.size(0), numBytes * 8 - numBits)
+        binary = torch.cat((binary, padding), 1)
+
+    binary = binary.reshape(-1, numBytes, 8)
+    weights = BIT_WEIGHTS.to(binary.device)
+
+    return (binary * weights).sum(2).to(torch.uint8)
+
+
+def unpackCodes(packedCodes, bits):
+    """
+    inverse of packCodes, float codes of shape (N, bits) with 0/1 values
+    """
+    weights = BIT_WEIGHTS.to(packedCodes.device)
+    binary = torch.bitwise_and(packedCodes.unsqueeze(2), weights).ne(0)
+
+    return binary.reshape(packedCodes.size(0), -1)[:, :bits].float()
+
+
+def packLabels(labels):
+    """
+    pack multi-hot labels of shape (N, classes) into uint8 rows padded to whole 64 bit words
+    """
+    packedLabels = packCodes(labels)
+    numBytes = (packedLabels.size(1) + 7) // 8 * 8
+    if numBytes != packedLabels.size(1):
+        padding = packedLabels.new_zeros(packedLabels.size(0), numBytes - packedLabels.size(1))
+        packedLabels = torch.cat((packedLabels, padding), 1)
+
+    return packedLabels
+
+
+def packedHammingDistances(packedQuery, packedDatabase):
+    """
+    hamming distances of shape (Q, N) between packed query codes and packed database codes (XOR + popcount)
+    """
+    table = POPCOUNT_TABLE.to(packedQuery.device)
+    xor = torch.bitwise_xor(packedQuery.unsqueeze(1), packedDatabase.unsqueeze(0))
+
+    return table[xor.long()].sum(2, dtype=torch.int32)
+
+
+def kSmallest(distances, k, numDatabase, indexOffset=0):
+    """
+    partial selection of the k smallest integer distances of each row, ties are broken by the smaller database index
+    :return: selection keys of shape (Q, k), key = distance * numDatabase + databaseIndex
+    """
+    indices = torch.arange(indexOffset, indexOffset + distances.size(1), device=distances.device)
+    keys = distances.long() * numDatabase + indices
+
+    return torch.topk(keys, min(k, keys.size(1)), dim=1, largest=False, sorted=True)[0]
+
+
+def packedKNearest(packedDatabase, packedQuery, k, blockSize=4096, excludeIndices=None):
+    """
+    k nearest database codes of each query code, scanned in blocks of the database
+    :param excludeIndices: database index of shape (Q,) left out for each query, e.g. the query itself
+    :return: distances and indices of shape (Q, k), ordered by distance and then by database index
+    """
+    numDatabase = packedDatabase.size(0)
+    if excludeIndices is None:
+        k = min(k, numDatabase)
+    else:
+        k = min(k, numDatabase - 1)
+        #larger than any hamming distance, excluded items are never among the k nearest
+        excludedDistance = packedDatabase.size(1) * 8 + 1
+
+    bestKeys = None
+
+    for start in range(0, numDatabase, blockSize):
+        distances = packedHammingDistances(packedQuery, packedDatabase[start:start + blockSize])
+        if excludeIndices is not None:
+            blockIndices = torch.arange(start, start + distances.size(1), device=distances.device)
+            distances = distances.masked_fill(excludeIndices.unsqueeze(1) == blockIndices, excludedDistance)
+        keys = kSmallest(distances, k, numDatabase, start)
+
+        if bestKeys is not None:
+            keys = torch.cat((bestKeys, keys), 1)
+            keys = torch.topk(keys, k, dim=1, largest=False, sorted=True)[0]
+        bestKeys = keys
+
+    return torch.div(bestKeys, numDatabase, rounding_mode='floor'), bestKeys % numDatabase
+
+
+
+class PackedHammingIndex(object):
+    """Keeps the database codes packed into bytes and answers k nearest neighbour queries"""
+    def __init__(self, codes, blockSize=4096):
+        self.bits = codes.size(1)
+        self.blockSize = blockSize
+        self.packedCodes = packCodes(codes)
+
+    @classmethod
+    def fromPacked(cls, packedCodes, bits, blockSize=4096):
+        index = cls.__new__(cls)
+        index.bits = bits
+        index.blockSize = blockSize
+        index.packedCodes = packedCodes
+        return index
+
+    def __len__(self):
+        return self.packedCodes.size(0)
+
+    def search(self, queryCodes, k):
+        return packedKNearest(self.packedCodes, packCodes(queryCodes), k, self.blockSize)
+
+
+
+def toBinaryArray(codes):
+    """
+    binary codes as a numpy uint8 array of 0/1 values
+    """
+    if torch.is_tensor(codes):
+        codes = codes.detach().cpu().numpy()
+    return (np.asarray(codes) >= 0.5).astype(np.uint8)
+
+
+def packedCodesHash(packedCodes):
+    """
+    sha1 of the packed codes, identifies the code set an index has been built from
+    """
+    return hashlib.sha1(np.ascontiguousarray(packedCodes).tobytes()).hexdigest()
+
+
+def gatherRanges(values, starts, stops):
+    """
+    concatenation of values[starts[i]:stops[i]] for all i without a python loop
+    """
+    counts = stops - starts
+    total = int(counts.sum())
+    if total == 0:
+        return values[:0]
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+    return values[offsets]
+
+
+
+class MultiIndexHashing(object):
+    """
+    Multi-index hashing (Norouzi et al., CVPR 2012) for exact k nearest neighbour search in Hamming space.
+    Codes are split into disjoint substrings and each substring is indexed by its own table.
+    If two codes differ in at most m*(r+1)-1 bits, they differ in at most r bits in one of the m substrings,
+    so probing every table with radius r finds all of them.
+    """
+    def __init__(self, codes=None, numSubstrings=None):
+        self.masks = {}
+        self.codesHash = None
+        if codes is not None:
+            self.build(codes, numSubstrings)
+
+    def build(self, codes, numSubstrings=None):
+        binary = toBinaryArray(codes)
+        numCodes, self.bits = binary.shape
+
+        if numSubstrings is None:
+            #substrings of about log2(N) bits
+            numSubstrings = int(round(self.bits / max(1.0, math.log2(max(numCodes, 2)))))
+        #keys have to fit into int64 and radius enumeration stays cheap below 32 bits
+        numSubstrings = min(self.bits, max(1, numSubstrings, (self.bits + 31) // 32))
+
+        self.bounds = np.linspace(0, self.bits, numSubstrings + 1).astype(np.int64)
+        self.packedCodes = np.packbits(binary, axis=1)
+        self.codesHash = packedCodesHash(self.packedCodes)
+        self.sortedKeys = []
+        self.sortedIds = []
+
+        for keys in self._substringKeys(binary):
+            order = np.argsort(keys, kind='stable')
+            self.sortedKeys.append(keys[order])
+            self.sortedIds.append(order.astype(np.int64))
+
+    def __len__(self):
+        return self.packedCodes.shape[0]
+
+    @property
+    def numSubstrings(self):
+        return len(self.bounds) - 1
+
+    def _substringKeys(self, binary):
+        keys = []
+        for start, stop in zip(self.bounds[:-1], self.bounds[1:]):
+            weights = np.left_shift(1, np.arange(stop - start - 1, -1, -1, dtype=np.int64))
+            keys.append(binary[:, start:stop].astype(np.int64).dot(weights))
+        return keys
+
+    def _radiusMasks(self, length, radius):
+        if (length, radius) not in self.masks:
+            masks = [sum(1 << b for b in bits) for bits in itertools.combinations(range(length), radius)]
+            self.masks[(length, radius)] = np.array(masks, dtype=np.int64)
+        return self.masks[(length, radius)]
+
+    def _searchOne(self, queryKeys, packedQuery, k):
+        numCodes = len(self)
+        popcount = POPCOUNT_TABLE.numpy()
+        lengths = self.bounds[1:] - self.bounds[:-1]
+
+        visited = np.zeros(numCodes, dtype=bool)
+        candidateIds = []
+        candidateDistances = []
+        numFound = 0
+
+        for radius in range(int(lengths.max()) + 1):
+            for j in range(self.numSubstrings):
+                if radius > lengths[j]:
+                    continue
+                probes = np.bitwise_xor(queryKeys[j], self._radiusMasks(int(lengths[j]), radius))
+                starts = np.searchsorted(self.sortedKeys[j], probes, side='left')
+                stops = np.searchsorted(self.sortedKeys[j], probes, side='right')
+
+                ids = gatherRanges(self.sortedIds[j], starts, stops)
+                ids = ids[~visited[ids]]
+                if len(ids) == 0:
+                    continue
+                visited[ids] = True
+                numFound += len(ids)
+
+                candidateIds.append(ids)
+                candidateDistances.append(popcount[np.bitwise_xor(self.packedCodes[ids], packedQuery)].sum(1, dtype=np.int64))
+
+            if numFound == numCodes:
+                break
+            #every code within this distance has been found
+            guaranteed = self.numSubstrings * (radius + 1) - 1
+            if numFound >= k and sum(int((d <= guaranteed).sum()) for d in candidateDistances) >= k:
+                break
+
+        ids = np.concatenate(candidateIds)
+        distances = np.concatenate(candidateDistances)
+        keys = np.sort(distances * numCodes + ids)[:k]
+
+        return keys // numCodes, keys % numCodes
+
+    def search(self, queryCodes, k):
+        """
+        exact k nearest neighbours, same result as the brute force scan of packedKNearest
+        :return: distances and indices of shape (Q, k), ordered by distance and then by database index
+        """
+        binary = toBinaryArray(queryCodes)
+        k = min(k, len(self))
+        queryKeys = self._substringKeys(binary)
+        packedQueries = np.packbits(binary, axis=1)
+
+        distances = np.empty((binary.shape[0], k), dtype=np.int64)
+        indices = np.empty((binary.shape[0], k), dtype=np.int64)
+        for i in range(binary.shape[0]):
+            distances[i], indices[i] = self._searchOne([keys[i] for keys in queryKeys], packedQueries[i], k)
+
+        device = queryCodes.device if torch.is_tensor(queryCodes) else 'cpu'
+        return torch.from_numpy(distances).to(device), torch.from_numpy(indices).to(device)
+
+    def save(self, fileName):
+        arrays = {'bits': np.array(self.bits), 'bounds': self.bounds, 'packedCodes': self.packedCodes,
+                  'numCodes': np.array(len(self)), 'codesHash': np.array(self.codesHash)}
+        for j in range(self.numSubstrings):
+            arrays['sortedKeys{}'.format(j)] = self.sortedKeys[j]
+            arrays['sortedIds{}'.format(j)] = self.sortedIds[j]
+        with open(fileName, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, fileName):
+        index = cls()
+        with np.load(fileName) as arrays:
+            index.bits = int(arrays['bits'])
+            index.bounds = arrays['bounds']
+            index.packedCodes = arrays['packedCodes']
+            index.sortedKeys = [arrays['sortedKeys{}'.format(j)] for j in range(index.numSubstrings)]
+            index.sortedIds = [arrays['sortedIds{}'.format(j)] for j in range(index.numSubstrings)]
+            index.codesHash = str(arrays['codesHash']) if 'codesHash' in arrays else None
+        return index
+
+    def matches(self, codes):
+        """
+        whether the index has been built from these codes, compared by number, bits and hash of the packed codes
+        """
+        binary = toBinaryArray(codes)
+        return (binary.shape == (len(self), self.bits) and
+                self.codesHash == packedCodesHash(np.packbits(binary, axis=1)))
+
+
+def loadMultiIndexHashing(fileName, codes):
+    """
+    load a saved multi-index hashing index, build and save it from the codes when it does not exist yet
+    or has been built from other codes (e.g. of an older code archive in the same folder)
+    """
+    if os.path.isfile(fileName):
+        index = MultiIndexHashing.load(fileName)
+        if index.matches(codes):
+            return index
+        print("=> '{}' has been built from other codes, rebuilding it".format(fileName))
+
+    index = MultiIndexHashing(codes)
+    index.save(fileName)
+    return index
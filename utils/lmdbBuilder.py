@@ -0,0 +1,141 @@
+"""
+parallel and resumable writing of the LMDB files of prep_splits
+"""
+import multiprocessing
+import os
+import numpy as np
+import lmdb
+
+from utils.lmdbRecord import dumpsRecord
+from utils.bandStatistics import BandStatistics, META_KEY
+
+
+#start value of the map size, it is doubled whenever a transaction does not fit anymore
+INITIAL_MAP_SIZE = 1 << 30
+
+#dataset, record and statistics functions of a pool worker process
+_worker = {}
+
+
+
+def _initWorker(dataGen, recordOfSample, statsOfSample):
+    _worker['dataGen'] = dataGen
+    _worker['recordOfSample'] = recordOfSample
+    _worker['statsOfSample'] = statsOfSample
+
+
+def _encodeSample(task):
+    """
+    key, serialized record and channel statistics of a sample (None when they are not computed for it),
+    raster reading, serialization and statistics all happen in the worker
+    """
+    output, idx, withStats = task
+    sample = _worker['dataGen'][idx]
+    key = u'{}'.format(sample['patch_name']).encode('ascii')
+    stats = BandStatistics.ofArrays(_worker['statsOfSample'](sample)) if withStats else None
+
+    return output, key, dumpsRecord(_worker['recordOfSample'](sample)), stats
+
+
+def committedStatistics(env):
+    """
+    channel statistics of the records which have been committed to the LMDB file
+    """
+    with env.begin() as txn:
+        meta = txn.get(META_KEY)
+    return BandStatistics.loads(meta) if meta is not None else BandStatistics()
+
+
+def committedKeys(env):
+    """
+    keys which have been committed to the LMDB file, by an interrupted build as well
+    """
+    with env.begin() as txn:
+        return set(bytes(key) for key in txn.cursor().iternext(keys=True, values=False))
+
+
+def putBatch(env, items):
+    """
+    put all items in one transaction, the map size is doubled until they fit
+    """
+    while True:
+        try:
+            with env.begin(write=True) as txn:
+                for key, value in items:
+                    txn.put(key, value)
+            return
+        except lmdb.MapFullError:
+            env.set_mapsize(env.info()['map_size'] * 2)
+
+
+def metaItems(stats, meta):
+    
+    return [(META_KEY, stats.dumps(meta))] if len(stats.count) > 0 or meta else []
+
+
+def buildLMDB(lmdbPath, dataGen, patchNames, recordOfSample, numWorkers=4, commitInterval=1000, statsOfSample=None, meta=None, statsIndices=None):
+    """
+    write the record of every sample of dataGen under its patch name, samples are read and serialized
+    by a pool of numWorkers processes and put in transactions of commitInterval records.
+    Committed records are the progress of the build, a build started again after an interruption
+    only reads the patches which are not in the LMDB file yet.
+    :param patchNames: patch names of the samples of dataGen in order, the keys without reading the rasters
+    :param recordOfSample: function which returns the tuple of arrays stored for a sample
+    :param statsOfSample: function which returns the named (C, H, W) arrays of a sample whose channel means and stds
+                          are stored under META_KEY, they are updated in the transaction of every batch of records
+    :param meta: additional json entries stored under META_KEY, e.g. the number of classes of the packed labels
+    :param statsIndices: indices of the samples the statistics are computed of, e.g. of the train split
+                         so the validation and test patches do not leak into the normalization, all samples by default
+    """
+    buildSplitLMDBs([lmdbPath], [range(len(patchNames))], dataGen, patchNames, recordOfSample, numWorkers, commitInterval, statsOfSample, meta,
+                    statsIndices)
+
+
+def buildSplitLMDBs(lmdbPaths, splitIndices, dataGen, patchNames, recordOfSample, numWorkers=4, commitInterval=1000, statsOfSample=None, meta=None,
+                    statsIndices=None):
+    """
+    buildLMDB for several LMDB files in a single pass over the rasters,
+    the samples splitIndices[i] of dataGen are written to lmdbPaths[i], each LMDB file gets the statistics of its samples
+    """
+    envs = []
+    keys = []
+    stats = []
+    todo = []
+    statsIndices = set(statsIndices) if statsIndices is not None else None
+    for output, (lmdbPath, indices) in enumerate(zip(lmdbPaths, splitIndices)):
+        if not os.path.isdir(lmdbPath):
+            os.makedirs(lmdbPath)
+        env = lmdb.open(lmdbPath, map_size=INITIAL_MAP_SIZE)
+        envs.append(env)
+        stats.append(committedStatistics(env))
+        keys.append([u'{}'.format(patchNames[idx]).encode('ascii') for idx in indices])
+        
+        done = committedKeys(env)
+        todo += [(output, idx, statsOfSample is not None and (statsIndices is None or idx in statsIndices))
+                 for idx, key in zip(indices, keys[-1]) if key not in done]
+
+    total = sum(len(outputKeys) for outputKeys in keys)
+    if len(todo) < total:
+        print("resuming with %d of %d patches already written" % (total - len(todo), total))
+
+    with multiprocessing.Pool(numWorkers, initializer=_initWorker, initargs=(dataGen, recordOfSample, statsOfSample)) as pool:
+        items = [[] for _ in envs]
+        for written, (output, key, value, sampleStats) in enumerate(pool.imap_unordered(_encodeSample, todo, chunksize=8), 1):
+            items[output].append((key, value))
+            if sampleStats is not None:
+                stats[output].merge(sampleStats)
+
+            if len(items[output]) == commitInterval:
+                putBatch(envs[output], items[output] + metaItems(stats[output], meta))
+                items[output] = []
+                print("[%d/%d]" % (total - len(todo) + written, total))
+
+    for env, outputItems, outputKeys, outputStats in zip(envs, items, keys, stats):
+        putBatch(env, outputItems + metaItems(outputStats, meta) + 
+                      [(b'__keys__', dumpsRecord((np.array(outputKeys),))),
+                       (b'__len__', dumpsRecord((np.array(len(outputKeys), dtype=np.int64),)))])
+
+    print("Flushing database ...")
+    for env in envs:
+        env.sync()
+        env.close()
@@ -0,0 +1,101 @@
+"""
+binary record layout of LMDB values which can be read without deserialisation
+
+layout:
+    magic (4 bytes) | version (uint16) | number of arrays (uint16)
+    for every array: dtype length (uint8) | dtype string | ndim (uint8) | shape (ndim x uint64)
+    arrays as raw contiguous bytes, each aligned to 16 bytes from the start of the record
+the arrays of a record are np.frombuffer views of the value, so values read from a
+transaction opened with buffers=True are not copied until the caller copies them
+"""
+import struct
+import numpy as np
+
+
+RECORD_MAGIC = b'BENR'
+RECORD_VERSION = 1
+RECORD_ALIGNMENT = 16
+
+RECORD_PREFIX = struct.Struct('<4sHH')
+
+
+
+def alignRecordOffset(offset):
+    return (offset + RECORD_ALIGNMENT - 1) // RECORD_ALIGNMENT * RECORD_ALIGNMENT
+
+
+def isRecord(buf):
+    return bytes(buf[:len(RECORD_MAGIC)]) == RECORD_MAGIC
+
+
+def dumpsRecord(arrays):
+    """
+    serialize a sequence of numpy arrays into a record
+    """
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+
+    header = bytearray(RECORD_PREFIX.pack(RECORD_MAGIC, RECORD_VERSION, len(arrays)))
+    for array in arrays:
+        dtype = array.dtype.str.encode('ascii')
+        header += struct.pack('<B', len(dtype)) + dtype
+        header += struct.pack('<B', array.ndim) + struct.pack('<{}Q'.format(array.ndim), *array.shape)
+
+    parts = [bytes(header)]
+    offset = len(header)
+    for array in arrays:
+        padding = alignRecordOffset(offset) - offset
+        parts.append(b'\0' * padding)
+        parts.append(array.tobytes())
+        offset += padding + array.nbytes
+
+    return b''.join(parts)
+
+
+def loadsRecord(buf):
+    """
+    tuple of the arrays of a record, as views of buf
+    """
+    magic, version, numArrays = RECORD_PREFIX.unpack_from(buf, 0)
+    if magic != RECORD_MAGIC or version != RECORD_VERSION:
+        raise ValueError('unsupported LMDB record')
+
+    offset = RECORD_PREFIX.size
+    descriptions = []
+    for _ in range(numArrays):
+        dtypeLength, = struct.unpack_from('<B', buf, offset)
+        dtype = np.dtype(bytes(buf[offset + 1:offset + 1 + dtypeLength]).decode('ascii'))
+        offset += 1 + dtypeLength
+
+        ndim, = struct.unpack_from('<B', buf, offset)
+        shape = struct.unpack_from('<{}Q'.format(ndim), buf, offset + 1)
+        offset += 1 + 8 * ndim
+
+        descriptions.append((dtype, shape))
+
+    arrays = []
+    for dtype, shape in descriptions:
+        offset = alignRecordOffset(offset)
+        count = int(np.prod(shape))
+        arrays.append(np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape(shape))
+        offset += count * dtype.itemsize
+
+    return tuple(arrays)
+
+
+def loads_pyarrow(buf):
+    """
+    Args:
+        buf: the output of `dumps_pyarrow` of the former LMDB files.
+    """
+    import pyarrow as pa
+
+    return pa.deserialize(buf)
+
+
+def loadsValue(buf):
+    """
+    read an LMDB value in the record layout or in the former pyarrow serialization
+    """
+    if isRecord(buf):
+        return loadsRecord(buf)
+    return loads_pyarrow(buf)
@@ -1,11 +1,13 @@
 """ 
 metrics utilized for evaluating multi-label CBIR system
 """
+import math
 import torch
-import numpy as np
 import os
 import rasterio
 
+from utils.hammingSearch import POPCOUNT_TABLE
+
 
 
 
@@ -29,72 +31,45 @@ class MetricTracker(object):
 
  
 
-def get_mAP(indices, nrof_neighbors,trainLabels,queryLabels):
-    
-    totalMap = 0
-    
-    for i in range(len(indices)):
-        acc = np.empty((0,)).astype(np.float)
-        correct = 0
-        
-        if type(queryLabels) == list:
-            queryLabel = queryLabels[i]
-        elif type(queryLabels) == torch.Tensor:
-            queryLabel = queryLabels
-        
-        for j in range(nrof_neighbors):            
-            similarity = torch.sum(torch.mul(queryLabel,trainLabels[indices[i][j]])).ge(1.0)
-            if similarity:
-                correct += 1
-                precision = (correct / float(j+1))
-                acc = np.append(acc, [precision, ], axis=0)
-            
-        if correct == 0:
-             singularMap = 0.
-        else:
-            num = np.sum(acc)
-            den = correct
-            singularMap =  num/den
-        totalMap += singularMap
-        
-    return totalMap
-
-def get_mAP_weighted(indices, nrof_neighbors,trainLabels,queryLabels):
+def averagePrecisions(indices, nrof_neighbors, trainLabels, queryLabels, weighted=False, packed=False):
+    """
+    (weighted) average precision of every query over its first nrof_neighbors retrieved items,
+    computed for the whole (Q, k) neighbour matrix at once
+    :param packed: the labels are bitsets packed by packLabels instead of multi-hot vectors
+    """
+    if type(queryLabels) == list:
+        queryLabels = torch.stack(queryLabels)
+    if queryLabels.dim() == 1:
+        queryLabels = queryLabels.unsqueeze(0)
+    
+    retrievedLabels = trainLabels[indices[:, :nrof_neighbors]]
+    
+    if packed:
+        #packed label bitsets of packLabels: relevant items share a set bit in one of the 64 bit words,
+        #the number of shared labels is the popcount of the AND
+        commonLabels = torch.bitwise_and(queryLabels.unsqueeze(1), retrievedLabels)
+        relevant = commonLabels.view(torch.int64).ne(0).any(2).double()
+        if weighted:
+            sharedLabels = POPCOUNT_TABLE.to(commonLabels.device)[commonLabels.long()].sum(2).double()
+    else:
+        sharedLabels = torch.sum(torch.mul(queryLabels.unsqueeze(1), retrievedLabels), 2).double()
+        relevant = sharedLabels.ge(1.0).double()
     
-    totalMap = 0
+    ranks = torch.arange(1, relevant.size(1) + 1, dtype=torch.float64, device=relevant.device)
+    if weighted:
+        #average cumulative gain, non relevant items share no labels
+        precisions = torch.cumsum(sharedLabels, 1) / ranks
+    else:
+        precisions = torch.cumsum(relevant, 1) / ranks
     
-    for i in range(len(indices)):
-        acgAverage = np.empty((0,)).astype(np.float)
-        numberOfSharedLabels = 0
-        correct = 0
-        
-        if type(queryLabels) == list:
-            queryLabel = queryLabels[i]
-        elif type(queryLabels) == torch.Tensor:
-            queryLabel = queryLabels
-        
-        for j in range(nrof_neighbors):
-            retrievedLabel = trainLabels[indices[i][j]]
-            
-            similarity = torch.sum(torch.mul(queryLabel,retrievedLabel))
-            if similarity.ge(1.0):
-                correct += 1
-                numberOfSharedLabels = numberOfSharedLabels + similarity
-                acg = (numberOfSharedLabels / float(j+1))
-                acgAverage = np.append(acgAverage, [acg], axis=0)
-                
-                        
-        if correct == 0:
-             singularMap = 0.
-        else:
-            num = np.sum(acgAverage)
-            den = correct
-            singularMap =  num/den
-        totalMap += singularMap
-        
-    return totalMap
+    correct = relevant.sum(1)
+    return torch.sum(precisions * relevant, 1) / correct.clamp(min=1.0)
 
+def get_mAP_batch(indices, nrof_neighbors,trainLabels,queryLabels,packed=False):
+    return averagePrecisions(indices, nrof_neighbors, trainLabels, queryLabels, packed=packed).sum().item()
 
+def get_mAP_weighted_batch(indices, nrof_neighbors,trainLabels,queryLabels,packed=False):
+    return averagePrecisions(indices, nrof_neighbors, trainLabels, queryLabels, weighted=True, packed=packed).sum().item()
 
 
 
@@ -102,6 +77,20 @@ def get_mAP_weighted(indices, nrof_neighbors,trainLabels,queryLabels):
 def calculateAverageMetric(sumMetric,totalSize):
     return sumMetric / totalSize * 100
 
+def meanConfidenceInterval(values, populationSize, z=1.96):
+    """
+    mean of per query values of a random query subset in percent and the half width of its normal confidence interval,
+    with the finite population correction of sampling without replacement it is 0 when all queries are evaluated
+    """
+    values = values.double()
+    numQueries = values.numel()
+    mean = values.mean().item() * 100
+    if numQueries < 2 or numQueries >= populationSize:
+        return mean, 0.0
+    
+    correction = math.sqrt((populationSize - numQueries) / (populationSize - 1))
+    return mean, z * values.std().item() / math.sqrt(numQueries) * correction * 100
+
 def lineWriteToFile(fileName,lines):
     with open(fileName, 'a') as file:
         for line in lines:
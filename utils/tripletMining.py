@@ -0,0 +1,76 @@
+"""
+in-batch triplet mining on the device of the batch, every item of a batch is the anchor of one triplet
+"""
+import torch
+
+
+#label: nearest and farthest labels, semihard and hard: positives and negatives chosen by the code distances
+MINING_MODES = ('label', 'semihard', 'hard')
+
+
+
+def labelDistances(labels):
+    """
+    hamming distances (B, B) between multi-hot labels and their overlaps (number of shared labels),
+    both from a single matmul: d(a, b) = |a| + |b| - 2 a.b
+    """
+    labels = labels.float()
+    overlap = labels @ labels.t()
+    counts = torch.diagonal(overlap)
+
+    return counts.unsqueeze(1) + counts.unsqueeze(0) - 2 * overlap, overlap
+
+
+def codeDistances(codesS1, codesS2):
+    """
+    euclidean distances (B, B) between the codes of the batch, averaged over both modalities
+    """
+    with torch.no_grad():
+        return (torch.cdist(codesS1, codesS1) + torch.cdist(codesS2, codesS2)) / 2
+
+
+def mineTriplets(labels, codesS1=None, codesS2=None, mode='label'):
+    """
+    batch indices of shape (3, B): row 0 the anchors (every item of the batch in order), row 1 their positives
+    and row 2 their negatives
+    :param mode: label: the positive has the smallest and the negative the largest label hamming distance to the anchor,
+                        ties are broken at random
+                 hard: the positive (shares a label with the anchor) farthest from the anchor in code space
+                       and the nearest negative (shares no label)
+                 semihard: a random positive and the nearest negative which is farther from the anchor than the positive,
+                           the nearest negative when there is none
+                 anchors without a positive or a negative in the batch fall back to the label mode
+    """
+    numItems = labels.size(0)
+    anchors = torch.arange(numItems, device=labels.device)
+    itself = torch.eye(numItems, dtype=torch.bool, device=labels.device)
+
+    distances, overlap = labelDistances(labels)
+
+    #distances are integers, noise below 1 only reorders ties
+    noisyDistances = distances + torch.rand_like(distances) * 0.5
+    positives = noisyDistances.masked_fill(itself, float('inf')).argmin(1)
+    negatives = noisyDistances.masked_fill(itself, -1.0).argmax(1)
+
+    if mode == 'label':
+        return torch.stack((anchors, positives, negatives))
+
+    distances = codeDistances(codesS1, codesS2)
+    isPositive = overlap.gt(0) & ~itself
+    isNegative = overlap.eq(0) & ~itself
+
+    if mode == 'hard':
+        minedPositives = distances.masked_fill(~isPositive, -1.0).argmax(1)
+    else:
+        minedPositives = torch.rand_like(distances).masked_fill(~isPositive, -1.0).argmax(1)
+    positives = torch.where(isPositive.any(1), minedPositives, positives)
+
+    negativeDistances = distances.masked_fill(~isNegative, float('inf'))
+    minedNegatives = negativeDistances.argmin(1)
+    if mode == 'semihard':
+        positiveDistances = distances.gather(1, positives.unsqueeze(1))
+        fartherDistances = negativeDistances.masked_fill(negativeDistances <= positiveDistances, float('inf'))
+        minedNegatives = torch.where(torch.isfinite(fartherDistances).any(1), fartherDistances.argmin(1), minedNegatives)
+    negatives = torch.where(isNegative.any(1), minedNegatives, negatives)
+
+    return torch.stack((anchors, positives, negatives))